@@ -0,0 +1,168 @@
+"""
+Bootstrap confidence intervals and paired significance tests over result files.
+
+Every evaluator maps an item to a vector (`item_vector`) whose sum over items determines the
+total score (`vector_statistic`), so a resample of the dataset is just a weighted sum of the
+item vectors. Resamples are drawn in chunks and evaluated with matrix products.
+
+    # 95% bootstrap CI of one result file
+    python3 ./scripts/analysis.py logs/result_a.jsonl
+    # paired bootstrap and permutation tests of two result files (items matched by id)
+    python3 ./scripts/analysis.py logs/result_a.jsonl logs/result_b.jsonl --num_resamples 10000
+"""
+import argparse
+import json
+import numpy as np
+from results_handling import load_existing_results, group_and_aggregate_results, metric_view, iter_results
+from evaluators import load_evaluator, metric_paths
+from templates import load_template
+
+
+# Upper bound on resamples x items held in memory at once
+MAX_CHUNK_ELEMENTS = 2 ** 24
+
+
+# =====================
+# Resampling
+# =====================
+
+def chunk_sizes(num_resamples, num_items):
+    chunk_size = max(1, MAX_CHUNK_ELEMENTS // max(num_items, 1))
+    for start in range(0, num_resamples, chunk_size):
+        yield min(chunk_size, num_resamples - start)
+
+
+def bootstrap_weights(rng, size, num_items):
+    """Returns a (size, num_items) matrix of how often each item is drawn in each resample."""
+    indices = rng.integers(0, num_items, size=(size, num_items))
+    offsets = (np.arange(size) * num_items)[:, None]
+    counts = np.bincount((indices + offsets).ravel(), minlength=size * num_items)
+    return counts.reshape(size, num_items).astype(np.float64)
+
+
+def bootstrap_ci(vectors, statistic, num_resamples=1000, confidence=0.95, seed=0):
+    """Percentile bootstrap confidence interval of the total score."""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    score = float(statistic(vectors.sum(axis=0, keepdims=True))[0])
+    samples = np.concatenate([
+        statistic(bootstrap_weights(rng, size, len(vectors)) @ vectors)
+        for size in chunk_sizes(num_resamples, len(vectors))
+    ])
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(samples, [alpha, 1 - alpha])
+    return {"score": score, "low": float(low), "high": float(high)}
+
+
+def paired_bootstrap_test(vectors_a, vectors_b, statistic, num_resamples=1000, confidence=0.95, seed=0):
+    """
+    Paired bootstrap over items matched by id: both systems are scored on the same resamples.
+    Returns the score difference (a - b), its confidence interval and a two-sided p-value.
+    """
+    vectors_a = np.asarray(vectors_a, dtype=np.float64)
+    vectors_b = np.asarray(vectors_b, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    delta = float(statistic(vectors_a.sum(axis=0, keepdims=True))[0] - statistic(vectors_b.sum(axis=0, keepdims=True))[0])
+    deltas = []
+    for size in chunk_sizes(num_resamples, len(vectors_a)):
+        weights = bootstrap_weights(rng, size, len(vectors_a))
+        deltas.append(statistic(weights @ vectors_a) - statistic(weights @ vectors_b))
+    deltas = np.concatenate(deltas)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(deltas, [alpha, 1 - alpha])
+    p_value = min(1.0, 2 * min(np.mean(deltas <= 0), np.mean(deltas >= 0)))
+    return {"delta": delta, "low": float(low), "high": float(high), "p_value": float(p_value)}
+
+
+def permutation_test(vectors_a, vectors_b, statistic, num_permutations=1000, seed=0):
+    """
+    Paired approximate randomization test: the outputs of the two systems are swapped per item
+    at random. Returns the score difference (a - b) and a two-sided p-value.
+    """
+    vectors_a = np.asarray(vectors_a, dtype=np.float64)
+    vectors_b = np.asarray(vectors_b, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    sum_a = vectors_a.sum(axis=0)
+    sum_b = vectors_b.sum(axis=0)
+    delta = float(statistic(sum_a[None, :])[0] - statistic(sum_b[None, :])[0])
+    difference = vectors_b - vectors_a
+    num_extreme = 0
+    for size in chunk_sizes(num_permutations, len(vectors_a)):
+        swaps = (rng.random((size, len(vectors_a))) < 0.5).astype(np.float64)
+        permuted_a = sum_a + swaps @ difference
+        permuted_b = sum_a + sum_b - permuted_a
+        permuted_deltas = statistic(permuted_a) - statistic(permuted_b)
+        num_extreme += int(np.sum(np.abs(permuted_deltas) >= abs(delta) - 1e-12))
+    return {"delta": delta, "p_value": (num_extreme + 1) / (num_permutations + 1)}
+
+
+# =====================
+# Result Files
+# =====================
+
+def load_item_vectors(result_path, metric_path, evaluator, output_lang):
+    """Returns {id: item vector} for the items of a result file."""
+    results = group_and_aggregate_results(load_existing_results(result_path))
+    vectors = {}
+    for data in results:
+        vector = evaluator.item_vector(metric_view(data, metric_path), output_lang)
+        if vector is None:
+            raise ValueError(f"The metric of {result_path} cannot be resampled per item.")
+        vectors[data['id']] = vector
+    return vectors
+
+
+def result_settings(result_path):
+    """Reads the metric and the output language recorded in a result file (in any of the storage formats)."""
+    first = next(iter_results(result_path), {})
+    output_lang = ''
+    try:
+        output_lang = load_template(first['template']).template_data.get('output_lang', '')
+    except (KeyError, OSError, ValueError):
+        pass
+    return first.get('metrics'), output_lang
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('result_paths', nargs='+', help='One result file (CI), or two result files (paired tests)')
+    parser.add_argument('--metric_path', type=str, default=None, help='Metric (defaults to the first one recorded in the result file)')
+    parser.add_argument('--metric_args', type=json.loads, default=None, help='Metric arguments in JSON format')
+    parser.add_argument('--num_resamples', type=int, default=1000, help='Number of bootstrap resamples / permutations')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    if len(args.result_paths) > 2:
+        parser.error("Pass one result file, or two result files to compare.")
+
+    recorded_metrics, output_lang = result_settings(args.result_paths[0])
+    metric_path = args.metric_path or next(iter(metric_paths(recorded_metrics)), None)
+    if not metric_path:
+        parser.error("The result file has no metric; pass --metric_path.")
+    evaluator = load_evaluator(metric_path, args.metric_args, cache_dir=None)
+
+    all_vectors = [load_item_vectors(path, metric_path, evaluator, output_lang) for path in args.result_paths]
+    report = {}
+    for path, vectors in zip(args.result_paths, all_vectors):
+        report[path] = bootstrap_ci(
+            list(vectors.values()), evaluator.vector_statistic, args.num_resamples, args.confidence, args.seed
+        )
+
+    if len(all_vectors) == 2:
+        common_ids = [id_value for id_value in all_vectors[0] if id_value in all_vectors[1]]
+        vectors_a = [all_vectors[0][id_value] for id_value in common_ids]
+        vectors_b = [all_vectors[1][id_value] for id_value in common_ids]
+        report["num_paired_items"] = len(common_ids)
+        report["paired_bootstrap"] = paired_bootstrap_test(
+            vectors_a, vectors_b, evaluator.vector_statistic, args.num_resamples, args.confidence, args.seed
+        )
+        report["permutation"] = permutation_test(
+            vectors_a, vectors_b, evaluator.vector_statistic, args.num_resamples, args.seed
+        )
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Startup-time benchmark for the CLI.
+
+Runs a tiny end-to-end job (test model, test dataset, test metric) several times and
+checks that none of the heavy backend libraries are imported on that path.
+Exits with a non-zero status if a heavy module is imported or the median wall time
+exceeds --max_seconds.
+
+    python3 ./scripts/bench_startup.py --runs 5 --max_seconds 1.0
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(SCRIPTS_DIR)
+HEAVY_MODULES = ["torch", "transformers", "openai", "boto3", "evaluate", "datasets"]
+
+
+def imported_heavy_modules():
+    """Imports main.py in a fresh interpreter and returns the heavy modules it pulled in."""
+    code = (
+        "import sys; sys.path.insert(0, {scripts!r}); import main; "
+        "print(' '.join(m for m in {heavy!r} if m in sys.modules))"
+    ).format(scripts=SCRIPTS_DIR, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return output.stdout.split()
+
+
+def time_test_job(result_dir):
+    result_path = os.path.join(result_dir, f"bench_{time.time_ns()}.jsonl")
+    command = [
+        sys.executable, os.path.join(SCRIPTS_DIR, "main.py"),
+        "--model_path", "test",
+        "--dataset_path", "test",
+        "--template_path", os.path.join(ROOT_DIR, "templates", "humaneval_template.json"),
+        "--metric_path", "test",
+        "--result_path", result_path,
+        "--no_cache",
+    ]
+    start = time.perf_counter()
+    subprocess.run(command, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='Number of timed runs')
+    parser.add_argument('--max_seconds', type=float, default=1.0, help='Allowed median wall time of a test job')
+    args = parser.parse_args()
+
+    heavy = imported_heavy_modules()
+    print("Heavy modules imported by main:", heavy or "none")
+
+    with tempfile.TemporaryDirectory() as result_dir:
+        timings = [time_test_job(result_dir) for _ in range(args.runs)]
+    median = statistics.median(timings)
+    print(f"Test job wall time: median {median:.3f}s, min {min(timings):.3f}s, max {max(timings):.3f}s")
+
+    if heavy or median > args.max_seconds:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "lm-chaineval-harness")
+
+
+# =====================
+# Base Class
+# =====================
+
+class SQLiteCache:
+    """
+    A persistent key-value cache stored in a single SQLite file.
+
+    Values are JSON-serialized. When the total size of the stored values exceeds
+    `max_size_mb`, the least recently used entries are evicted. The file can be
+    shared by several processes (WAL mode).
+    """
+    def __init__(self, cache_path, max_size_mb=1024):
+        directory = os.path.dirname(cache_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.cache_path = cache_path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Hashes JSON-serializable parts into a cache key."""
+        serialized = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list) -> dict:
+        """Returns a dict of the cached values for the given keys (missing keys are omitted)."""
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+            if found:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE cache SET accessed = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self.connection.commit()
+        return found
+
+    def put_many(self, items: dict):
+        """Stores the given key-value pairs and evicts old entries if the cache is too large."""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            serialized = json.dumps(value, ensure_ascii=False)
+            rows.append((key, serialized, len(serialized.encode("utf-8")), now))
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, size, accessed) VALUES (?, ?, ?, ?)", rows
+            )
+            self.connection.commit()
+            self.evict()
+
+    def evict(self):
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        # 上限の9割まで、最も古くアクセスされたエントリから削除する
+        excess = total_size - int(self.max_size * 0.9)
+        removed = 0
+        keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            keys.append((key,))
+            removed += size
+            if removed >= excess:
+                break
+        self.connection.executemany("DELETE FROM cache WHERE key = ?", keys)
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# =====================
+# Generation Cache
+# =====================
+
+class GenerationCache(SQLiteCache):
+    """Caches model outputs keyed by model id, generation arguments and prompt text."""
+    def key(self, model_id, model_args, prompt) -> str:
+        return self.make_key("generation", model_id, model_args, prompt)
+
+
+# =====================
+# Execution Cache
+# =====================
+
+class ExecutionCache(SQLiteCache):
+    """Caches code execution results keyed by candidate code, test program, timeout and memory limit."""
+    def key(self, candidate, test, timeout, memory_limit_mb) -> str:
+        return self.make_key("execution", candidate, test, timeout, memory_limit_mb)
+
+
+# =====================
+# Utility Function
+# =====================
+
+def load_generation_cache(cache_dir=None, max_size_mb=1024):
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    return GenerationCache(os.path.join(cache_dir, "generations.sqlite"), max_size_mb)
+
+
+def load_execution_cache(cache_dir=None, max_size_mb=1024):
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    return ExecutionCache(os.path.join(cache_dir, "executions.sqlite"), max_size_mb)
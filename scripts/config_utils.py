@@ -7,23 +7,39 @@ def load_config(yaml_file):
     with open(yaml_file, 'r') as file:
         return yaml.safe_load(file)
 
-def parse_args_and_config():
+# Arguments that describe one evaluation job (as opposed to the model), accepted by the server mode
+JOB_ARGS = ['dataset_path', 'dataset_args', 'template_path', 'metric_path', 'metric_args', 'result_path', 'batch_size', 'max_batch_tokens', 'debug_mode']
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', type=str, default=None, help='Path to the config YAML file')
     parser.add_argument('--model_path', type=str, help='Path to the model file')
     parser.add_argument('--model_args', type=json.loads, default=None, help='Model arguments in JSON format')
     parser.add_argument('--quantize_model', action='store_true', help='Enable model quantization with bitsandbytes')
+    parser.add_argument('--batch_size', type=int, default=None, help='Number of prompts passed to the model in one generation call')
+    parser.add_argument('--max_batch_tokens', type=int, default=None, help='Token budget (prompts x longest prompt) per generation batch')
+    parser.add_argument('--commit_interval', type=float, default=None, help='Seconds between group commits of buffered result rows (0 commits every batch)')
+    parser.add_argument('--fsync_interval', type=float, default=None, help='Seconds between fsync checkpoints of the result file (0 fsyncs only at the end)')
+    parser.add_argument('--num_workers', type=int, default=None, help='Number of worker processes, each with its own model replica')
     parser.add_argument('--openai_api_key', type=str, default=None, help='OpenAI API token')
     parser.add_argument('--hf_token', type=str, default=None, help='HuggingFace API token')
     parser.add_argument('--aws_access_key_id', type=str, default=None, help='AWS access key ID')
     parser.add_argument('--aws_secret_access_key', type=str, default=None, help='AWS secret access key')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of the persistent generation cache')
+    parser.add_argument('--cache_max_size', type=float, default=None, help='Maximum size of the generation cache in MB')
+    parser.add_argument('--no_cache', action='store_true', help='Bypass the generation cache')
     parser.add_argument('--dataset_path', type=str, help='Path to the dataset file')
     parser.add_argument('--dataset_args', type=json.loads, default=None, help='Dataset arguments in JSON format')
     parser.add_argument('--template_path', type=str, help='Path to the template file')
-    parser.add_argument('--metric_path', type=str, default=None, help='Path to the metric file')
-    parser.add_argument('--metric_args', type=json.loads, default=None, help='Metric arguments in JSON format')
-    parser.add_argument('--result_path', type=str, default=None, help='Path to the result file')
+    parser.add_argument('--metric_path', type=str, nargs='+', default=None, help='Path(s) of the metrics; several metrics score the same outputs')
+    parser.add_argument('--metric_args', type=json.loads, default=None, help='Metric arguments in JSON format (may be keyed by metric path)')
+    parser.add_argument('--result_path', type=str, default=None, help='Path to the result file (.jsonl, .norm.jsonl[.gz/.zst] or a .sqlite/.db database)')
     parser.add_argument('--debug_mode', action='store_true', help='Enable debug mode for verbose output')
+    parser.add_argument('--server_url', type=str, default=None, help='Submit the job to a running model server instead of loading the model')
+    return parser
+
+def parse_args_and_config(parser=None, required_args=None):
+    parser = parser or build_parser()
     args = parser.parse_args()
 
     if args.config:
@@ -38,15 +54,36 @@ def parse_args_and_config():
                         if getattr(args, arg_name) is None:
                             setattr(args, arg_name, value)
 
-    check_required_args(args)
+    check_required_args(args, required_args)
+    fill_default_args(args)
+    return args
+
+def fill_default_args(args):
+    if args.num_workers is None:
+        args.num_workers = 1
+
+    if args.commit_interval is None:
+        args.commit_interval = 1.0
+
+    if args.fsync_interval is None:
+        args.fsync_interval = 0
+
+    if args.cache_max_size is None:
+        args.cache_max_size = 1024
 
     if args.result_path is None:
         args.result_path = f'./logs/result_{int(time.time())}.jsonl'
 
-    return args
+    # 評価指標が1つの場合は従来どおり文字列として扱う
+    if isinstance(args.metric_path, list) and len(args.metric_path) == 1:
+        args.metric_path = args.metric_path[0]
 
-def check_required_args(args):
-    required_args = ['model_path', 'dataset_path', 'template_path']
+def check_required_args(args, required_args=None):
+    if required_args is None:
+        if getattr(args, 'server_url', None):
+            required_args = ['dataset_path', 'template_path']
+        else:
+            required_args = ['model_path', 'dataset_path', 'template_path']
     for arg in required_args:
         if getattr(args, arg, None) is None:
             raise ValueError(f"Error: '{arg}' is required but not provided in command line arguments or config file.")
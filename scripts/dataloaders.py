@@ -1,6 +1,5 @@
 from abc import ABC, abstractmethod
 import json
-from datasets import load_dataset
 
 
 # =====================
@@ -72,6 +71,9 @@ class HFDataLoader(DataLoader):
         self.dataset_num = self.dataset_args.get('num')
 
     def load(self) -> list[dict]:
+        # datasets は HuggingFace のデータセットを読む場合にのみ読み込む
+        from datasets import load_dataset
+
         split = self.dataset_args.get("split", "test")
         subset = self.dataset_args.get("subset")
 
@@ -0,0 +1,190 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# =====================
+# Rate Limiting
+# =====================
+
+class TokenBucket:
+    """An asyncio token bucket that refills continuously at `per_minute` units per minute."""
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        """Waits until `amount` units are available and consumes them."""
+        amount = min(float(amount), self.capacity)
+        async with self.lock:
+            self.refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= amount
+
+
+# =====================
+# Async Request Dispatcher
+# =====================
+
+class AsyncDispatcher:
+    """
+    Sends many API requests concurrently and returns the results in input order.
+
+    At most `max_in_flight` requests are outstanding at once, requests/min and tokens/min
+    are limited by token buckets, and retryable errors (429/5xx) are retried with
+    exponential backoff. The dispatcher owns a single event loop so that clients created
+    on it (and their connection pools) are reused across calls to `run`.
+    """
+    def __init__(self, max_in_flight=8, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=6, initial_backoff=1.0, max_backoff=60.0):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = None
+        self.request_bucket = None
+        self.token_bucket = None
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.loop.run_until_complete(self.setup())
+
+    async def setup(self):
+        # asyncio primitives are created on the dispatcher's own loop
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        if self.requests_per_minute:
+            self.request_bucket = TokenBucket(self.requests_per_minute)
+        if self.tokens_per_minute:
+            self.token_bucket = TokenBucket(self.tokens_per_minute)
+
+    def run_coroutine(self, coroutine):
+        """Runs a coroutine on the dispatcher's event loop."""
+        return self.loop.run_until_complete(coroutine)
+
+    def run(self, request_fn, payloads, cost_fn=None, retry_after_fn=None):
+        """
+        Calls `await request_fn(payload)` for every payload and returns the results in order.
+
+        `cost_fn(payload)` estimates the tokens a request consumes, and `retry_after_fn(exc)`
+        returns the delay in seconds before retrying a failed request, or None if the error
+        is not retryable.
+        """
+        return self.run_coroutine(self.dispatch(request_fn, payloads, cost_fn, retry_after_fn))
+
+    async def dispatch(self, request_fn, payloads, cost_fn, retry_after_fn):
+        tasks = [self.send(request_fn, payload, cost_fn, retry_after_fn) for payload in payloads]
+        return await asyncio.gather(*tasks)
+
+    async def send(self, request_fn, payload, cost_fn, retry_after_fn):
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                if self.request_bucket:
+                    await self.request_bucket.acquire(1)
+                if self.token_bucket and cost_fn:
+                    await self.token_bucket.acquire(cost_fn(payload))
+                try:
+                    return await request_fn(payload)
+                except Exception as e:
+                    delay = retry_after_fn(e) if retry_after_fn else None
+                    if delay is None or attempt == self.max_retries:
+                        raise
+                    backoff = min(self.max_backoff, self.initial_backoff * (2 ** attempt))
+                    await asyncio.sleep(max(delay, backoff * random.uniform(0.5, 1.0)))
+
+    def close(self):
+        self.loop.close()
+
+
+# =====================
+# Threaded Request Dispatcher
+# =====================
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of concurrent requests, adapting the limit to throttling (AIMD).
+
+    The limit is halved whenever a request is throttled and grows by one after
+    `limit` consecutive successful requests, never exceeding `max_limit`.
+    """
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.max_limit, self.limit + 1)
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class ThreadPoolDispatcher:
+    """
+    Sends blocking API requests from a bounded thread pool and returns the results in input order.
+
+    Requests that fail with a throttling error are retried with exponential backoff,
+    and the number of concurrent requests is reduced while throttling persists.
+    """
+    def __init__(self, max_workers=8, max_retries=6, initial_backoff=1.0, max_backoff=60.0):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.limiter = AdaptiveConcurrencyLimiter(max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def run(self, request_fn, payloads, throttled_fn=None):
+        """
+        Calls `request_fn(payload)` for every payload and returns the results in order.
+
+        `throttled_fn(exc)` tells whether a failed request was throttled and should be retried.
+        """
+        futures = [self.executor.submit(self.send, request_fn, payload, throttled_fn) for payload in payloads]
+        return [future.result() for future in futures]
+
+    def send(self, request_fn, payload, throttled_fn):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            try:
+                result = request_fn(payload)
+            except Exception as e:
+                throttled = bool(throttled_fn and throttled_fn(e))
+                self.limiter.release(throttled=throttled)
+                if not throttled or attempt == self.max_retries:
+                    raise
+                backoff = min(self.max_backoff, self.initial_backoff * (2 ** attempt))
+                time.sleep(backoff * random.uniform(0.5, 1.0))
+                continue
+            self.limiter.release()
+            return result
+
+    def close(self):
+        self.executor.shutdown()
@@ -1,7 +1,5 @@
-from evaluate import load
-import os
-import re
-os.environ["HF_ALLOW_CODE_EVAL"] = "1"
+from executors import ExecutionPool
+from caches import load_execution_cache
 
 # =====================
 # Base Class
@@ -14,10 +12,34 @@ class Evaluator:
     """
 
     def __init__(self, metric_path, metric_args):
-        if metric_path != "test":
-            self.metric = load(metric_path)
+        self.metric = self.load_metric(metric_path)
         self.metric_args = metric_args
         self.item_scores = []
+
+    def load_metric(self, metric_path):
+        """
+        Load the metric used by this evaluator.
+        """
+        if metric_path == "test":
+            return None
+        # 組み込みの実装を使う (ハブからのメトリクススクリプトの読み込みは行わない)
+        from metrics import load_metric
+        return load_metric(metric_path)
+
+    def output_texts(self, data):
+        """
+        Returns the collated samples of an item as strings ('' for missing ones, `output` for xml formats).
+        """
+        samples = data.get('formatted_output')
+        if not isinstance(samples, list):
+            samples = [samples]
+        texts = []
+        for sample in samples:
+            # xml形式では {"formatted_correctly", "output"} の辞書になっている
+            if isinstance(sample, dict):
+                sample = sample.get('output')
+            texts.append(sample if isinstance(sample, str) else '')
+        return texts
     
     def item_calculate(self, data, record, output_lang):
         """
@@ -25,11 +47,80 @@ class Evaluator:
         """
         raise NotImplementedError("Must implement item_calculate in subclass")
 
+    def batch_calculate(self, data_list, record, output_lang):
+        """
+        Calculate the scores for a group of items at once (one score per item, in order).
+        """
+        return [self.item_calculate(data, record, output_lang) for data in data_list]
+
+    def close(self):
+        """
+        Releases the resources held by the evaluator (e.g. worker processes).
+        """
+        pass
+
+    def init_state(self):
+        """
+        Returns an empty running-aggregate state (JSON-serializable), or None if the evaluator
+        can only aggregate over the whole dataset. The default state is the mean of item_score.
+        """
+        return {"sum": 0.0, "count": 0}
+
+    def update_state(self, state, data, output_lang):
+        """
+        Folds one scored item into the state and returns the state.
+        """
+        if data.get('item_score', '') != '':
+            state["sum"] += data['item_score']
+            state["count"] += 1
+        return state
+
+    def merge_state(self, state, other):
+        """
+        Merges two states (e.g. the persisted one and the one of the newly processed items).
+        """
+        state["sum"] += other["sum"]
+        state["count"] += other["count"]
+        return state
+
+    def finalize(self, state):
+        """
+        Calculates the total score from the state.
+        """
+        return state["sum"] / state["count"] if state["count"] else 0.00
+
+    def query_state(self, store, metric_path):
+        """
+        Computes the state of all items of a result database with SQL (see results_handling.SQLiteResultStore),
+        or returns None if the items have to be folded one by one.
+        """
+        return store.score_totals(metric_path)
+
+    def item_vector(self, data, output_lang):
+        """
+        Returns the per-item vector whose sum over items determines the total score (used for
+        bootstrap resampling in analysis.py), or None if the metric cannot be split per item.
+        """
+        if data.get('item_score', '') == '':
+            return [0.0, 0.0]
+        return [float(data['item_score']), 1.0]
+
+    def vector_statistic(self, sums):
+        """
+        Calculates the total score for every row of summed item vectors (NumPy array) at once.
+        """
+        import numpy as np
+        counts = sums[:, 1]
+        return np.where(counts > 0, sums[:, 0] / np.maximum(counts, 1), 0.0)
+
     def total_calculate(self, dataset, record, output_lang):
         """
         Aggregate the scores of all items and calculate the total score.
         """
-        raise NotImplementedError("Must implement total_calculate in subclass")
+        state = self.init_state()
+        for data in dataset:
+            state = self.update_state(state, data, output_lang)
+        return self.finalize(state)
 
 
 # =====================
@@ -55,12 +146,7 @@ class TestEvaluator(Evaluator):
         self.item_scores.append(item_score)
         return item_score
     
-    def total_calculate(self, dataset, record, output_lang):
-        if self.item_scores:
-            total_score = sum(self.item_scores) / len(self.item_scores)
-        else:
-            total_score = 0
-        return total_score
+    # 全体スコアは基底クラスの状態 (item_score の合計と件数) から計算する
 
 
 
@@ -71,8 +157,29 @@ class TestEvaluator(Evaluator):
 
 class CodeEvalEvaluator(Evaluator):
     """
-    コード評価用Evaluatorクラス。HuggingFaceのevaluate-metric/code_evalを使用してスコアを算出する。
+    コード評価用Evaluatorクラス。候補コードとテストを実行プールで並列に実行し、pass@k を算出する。
+    アイテムごとに正解数 (num_correct) と候補数 (num_samples) を記録し、全体スコアは不偏推定量で計算する。
+    metric_args: k (pass@k の k のリスト), num_workers (並列数), timeout (秒), memory_limit_mb (メモリ上限)
+    `num_workers` は metric_args で指定されない場合の並列数 (None の場合は CPU コア数)
     """
+    def __init__(self, metric_path, metric_args, execution_cache=None, num_workers=None):
+        super().__init__(metric_path, metric_args)
+        metric_args = metric_args or {}
+        k = metric_args.get('k', [1])
+        self.k = [k] if isinstance(k, int) else list(k)
+        self.timeout = metric_args.get('timeout', 3.0)
+        self.pool = ExecutionPool(
+            num_workers=metric_args.get('num_workers', num_workers),
+            timeout=self.timeout,
+            memory_limit_mb=metric_args.get('memory_limit_mb', 1024),
+        )
+        self.execution_cache = execution_cache
+
+    def close(self):
+        self.pool.close()
+        if self.execution_cache:
+            self.execution_cache.close()
+
     def is_blank(self, candidates):
         if isinstance(candidates, list):
             for sublist in candidates:
@@ -82,23 +189,109 @@ class CodeEvalEvaluator(Evaluator):
         return False
 
     def item_calculate(self, data, record, output_lang):
-        test_cases = [data['reference']]
-        candidates = [data['formatted_output']]
-        if not self.is_blank(candidates):
-            pass_at_k, results = self.metric.compute(references=test_cases, predictions=candidates, k=[1])
-            item_score = pass_at_k['pass@1']
+        return self.batch_calculate([data], record, output_lang)[0]
+
+    def batch_calculate(self, data_list, record, output_lang):
+        # 全アイテムの (候補コード, テスト) をまとめて実行プールに渡す
+        pairs = []
+        spans = []
+        for data in data_list:
+            candidates = data['formatted_output']
+            if self.is_blank([candidates]):
+                spans.append(None)
+                continue
+            start = len(pairs)
+            pairs.extend((candidate, data['reference']) for candidate in candidates)
+            spans.append((start, len(pairs)))
+
+        passed = self.execute(pairs)
+
+        item_scores = []
+        for data, span in zip(data_list, spans):
+            if span is None or span[0] == span[1]:
+                data['num_correct'] = 0
+                data['num_samples'] = len(data['formatted_output'] or [])
+                item_scores.append(0.00)
+            else:
+                start, end = span
+                data['num_correct'] = sum(passed[start:end])
+                data['num_samples'] = end - start
+                item_scores.append(data['num_correct'] / data['num_samples'])
+        return item_scores
+
+    def execute(self, pairs):
+        """Runs (candidate, test) pairs and returns pass/fail per pair.
+
+        Identical pairs are executed once, and results already in the execution cache are reused.
+        """
+        if self.execution_cache:
+            keys = [
+                self.execution_cache.key(candidate, test, self.timeout, self.pool.memory_limit_mb)
+                for candidate, test in pairs
+            ]
         else:
-            item_score = 0.00
-        # self.item_scores.append(item_score)
-        return item_score
+            keys = [(candidate, test) for candidate, test in pairs]
+        results = self.execution_cache.get_many(list(set(keys))) if self.execution_cache else {}
+
+        pending = {}
+        for key, (candidate, test) in zip(keys, pairs):
+            if key not in results and key not in pending:
+                pending[key] = candidate + "\n" + test
+        if pending:
+            new_results = dict(zip(pending.keys(), self.pool.run(list(pending.values()))))
+            if self.execution_cache:
+                self.execution_cache.put_many(new_results)
+            results.update(new_results)
+        return [results[key] for key in keys]
     
-    def total_calculate(self, all_data, record, output_lang):
-        existing_scores = [data['item_score'] for data in all_data if 'item_score' in data]
-        if existing_scores:
-            total_score = sum(existing_scores) / len(existing_scores)
-        else:
-            total_score = 0.00
-        return total_score
+    def sample_counts(self, data):
+        """Returns (num_samples, num_correct) of an item, or None if it has not been scored."""
+        if 'num_samples' in data:
+            return data['num_samples'], data['num_correct']
+        if data.get('item_score', '') == '':
+            return None
+        # カウントを持たない古い結果ファイルは item_score (= 正解率) と候補数から復元する
+        formatted_output = data.get('formatted_output')
+        num_samples = len(formatted_output) if isinstance(formatted_output, list) else 1
+        return num_samples, round(data['item_score'] * num_samples)
+
+    def item_vector(self, data, output_lang):
+        # 先頭の k の pass@k を平均する (候補数が k 未満のアイテムは件数に含めない)
+        from metrics import estimate_pass_at_k
+        counts = self.sample_counts(data)
+        if counts is None or counts[0] < self.k[0]:
+            return [0.0, 0.0]
+        return [float(estimate_pass_at_k([counts[0]], [counts[1]], self.k[0])[0]), 1.0]
+
+    def init_state(self):
+        # (候補数, 正解数) の組ごとのアイテム数
+        return {"counts": {}}
+
+    def update_state(self, state, data, output_lang):
+        counts = self.sample_counts(data)
+        if counts is not None:
+            key = f"{counts[0]}/{counts[1]}"
+            state["counts"][key] = state["counts"].get(key, 0) + 1
+        return state
+
+    def merge_state(self, state, other):
+        for key, frequency in other["counts"].items():
+            state["counts"][key] = state["counts"].get(key, 0) + frequency
+        return state
+
+    def query_state(self, store, metric_path):
+        return {"counts": store.sample_count_histogram(metric_path)}
+
+    def finalize(self, state):
+        from metrics import mean_pass_at_k
+        pairs = [tuple(map(int, key.split("/"))) for key in state["counts"]]
+        num_samples = [pair[0] for pair in pairs]
+        num_correct = [pair[1] for pair in pairs]
+        scores = mean_pass_at_k(num_samples, num_correct, self.k, weights=list(state["counts"].values()))
+        if len(self.k) == 1:
+            return scores.get(f"pass@{self.k[0]}", 0.00)
+        return scores
+
     # def total_calculate(self, dataset, record, output_lang):
     #     if self.item_scores:
     #         total_score = sum(self.item_scores) / len(self.item_scores) 
@@ -108,7 +301,7 @@ class CodeEvalEvaluator(Evaluator):
 
 
 class AccuracyEvaluator(Evaluator):
-    # 正確性評価用のEvaluatorクラスの実装は省略
+    # 正確性評価用のEvaluatorクラス
 
 
     # def calculate(self, dataset, record):
@@ -125,16 +318,18 @@ class AccuracyEvaluator(Evaluator):
     #     return score, dataset
 
     def item_calculate(self, data, record, output_lang):
-        return None
-    
-    def total_calculate(self, dataset, record, output_lang):
-        predictions = [int(data['model_output']) for data in dataset]
-        references = [int(data['reference']) for data in dataset]
-        total_score = self.metric.compute(predictions=predictions, references=references)['accuracy']
-        return total_score
+        # 先頭のサンプルを予測ラベルとして参照ラベルと比較する (全体スコアは基底クラスの平均)
+        item_score = self.metric([(self.output_texts(data) or [''])[0]], [data['reference']])
+        self.item_scores.append(item_score)
+        return item_score
 
 
 class BLEUEvaluator(Evaluator):
+    """
+    BLEU評価用Evaluatorクラス。各サンプルを一度だけトークナイズし、n-gram 統計量 (bleu_stats) をアイテムごとに記録する。
+    全体スコアは記録済みの統計量を合計したコーパス BLEU として計算する (smooth あり)。
+    """
+
     # def calculate(self, dataset, record):
 
     #     # BLEUメトリック用のデータ準備
@@ -148,58 +343,61 @@ class BLEUEvaluator(Evaluator):
 
     #     return score, dataset
 
-    # 日本語用のtokenizer
-    # Python: 正規表現による簡易版形態素解析
-    # https://qiita.com/kinoshita_yuri/items/e15f143981f1616994ed
-    def tokenize_ja(text):
-        pJA = re.compile(r"/|[A-Z]+|[a-z]+|[ァ-ンー]+|[ぁ-ん-]+|[ァ-ヶ]+|[一-龍]+|[。、]|/")
-        text_m = []
-        m = pJA.findall(text)
-        for row in m:
-            if re.compile(r'^[あ-ん]+$').fullmatch(row):
-                if row[0] in 'はがのにへともでを':
-                    prefix = row[0]
-                    token = row[1:]
-                    text_m.append(prefix)
-                    if (len(token) > 0):
-                        text_m.append(token)
-                elif row[-2:] in 'のでからまで':
-                    token = row[0:-2]
-                    suffix = row[-2:]
-                    text_m.append(token)
-                    text_m.append(suffix)
-                elif row[-1:] in 'もはがでを':
-                    token = row[0:-1]
-                    suffix = row[-1:]
-                    text_m.append(token)
-                    text_m.append(suffix)
-                else:
-                    text_m.append(row)
-            else:
-                text_m.append(row)
-        return text_m
-    
+    def item_stats(self, data, output_lang):
+        from metrics import BLEUStats, load_tokenizer
+        tokenize = load_tokenizer(output_lang)
+        references = data['reference'] if isinstance(data['reference'], list) else [data['reference']]
+        references_tokens = [tokenize(reference) for reference in references]
+        stats = BLEUStats()
+        for text in self.output_texts(data):
+            stats.add(tokenize(text), references_tokens)
+        return stats
+
     def item_calculate(self, data, record, output_lang):
-        predictions = [data['formatted_output']]
-        references = [[data['reference']]]
-        if output_lang == 'ja':
-            item_score = self.metric.compute(predictions=predictions, references=references, tokenier=tokenize_ja, smooth=True)['bleu']
-        else:
-            item_score = self.metric.compute(predictions=predictions, references=references, smooth=True)['bleu']
+        stats = self.item_stats(data, output_lang)
+        data['bleu_stats'] = stats.to_dict()
+        item_score = stats.score(smooth=True)
         self.item_scores.append(item_score)
-        
         return item_score
 
-    def total_calculate(self, dataset, record, output_lang):
-        predictions = [data['formatted_output'] for data in dataset]
-        references = [[data['reference']] for data in dataset]
-        if output_lang == 'ja':
-            total_score = self.metric.compute(predictions=predictions, references=references, tokenier=tokenize_ja, smooth=True)['bleu']
+    def init_state(self):
+        from metrics import BLEUStats
+        return BLEUStats().to_dict()
+
+    def update_state(self, state, data, output_lang):
+        from metrics import BLEUStats
+        if 'bleu_stats' in data:
+            stats = BLEUStats.from_dict(data['bleu_stats'])
+        elif data.get('formatted_output') is not None:
+            stats = self.item_stats(data, output_lang)
         else:
-            total_score = self.metric.compute(predictions=predictions, references=references, smooth=True)['bleu']
+            return state
+        return BLEUStats.from_dict(state).merge(stats).to_dict()
+
+    def merge_state(self, state, other):
+        from metrics import BLEUStats
+        return BLEUStats.from_dict(state).merge(BLEUStats.from_dict(other)).to_dict()
+
+    def query_state(self, store, metric_path):
+        # 統計量を持たないアイテムがある場合は、出力をトークナイズして集計する
+        return store.bleu_stats_sums()
+
+    def finalize(self, state):
+        from metrics import BLEUStats
+        return BLEUStats.from_dict(state).score(smooth=True)
+
+    def item_vector(self, data, output_lang):
+        from metrics import BLEUStats
+        if 'bleu_stats' in data:
+            return BLEUStats.from_dict(data['bleu_stats']).to_vector()
+        if data.get('formatted_output') is not None:
+            return self.item_stats(data, output_lang).to_vector()
+        return BLEUStats().to_vector()
+
+    def vector_statistic(self, sums):
+        from metrics import bleu_from_sums
+        return bleu_from_sums(sums, smooth=True)
 
-        return total_score
-        
 
 class F1Evaluator(Evaluator):
     # def calculate(self, dataset, record):
@@ -219,29 +417,49 @@ class F1Evaluator(Evaluator):
     #     return score, dataset
     def item_calculate(self, data, record, output_lang):
         return None
-    
-    def total_calculate(self, dataset, record, output_lang):
-        predictions = [int(data['model_output']) for data in dataset]
-        references = [int(data['reference']) for data in dataset]
-        total_score = self.metric.compute(predictions=predictions, references=references)["f1"]
-        return total_score
+
+    def item_counts(self, data):
+        from metrics import confusion_counts
+        return confusion_counts([(self.output_texts(data) or [''])[0]], [data.get('reference', '')])
+
+    def init_state(self):
+        # 正例ラベル (1) についての混同行列の件数
+        return {"tp": 0, "fp": 0, "fn": 0}
+
+    def update_state(self, state, data, output_lang):
+        return self.merge_state(state, self.item_counts(data))
+
+    def merge_state(self, state, other):
+        for key in state:
+            state[key] += other[key]
+        return state
+
+    def query_state(self, store, metric_path):
+        # 出力と参照の比較が必要なため SQL では集計しない
+        return None
+
+    def finalize(self, state):
+        from metrics import f1_from_counts
+        return f1_from_counts(state["tp"], state["fp"], state["fn"])
+
+    def item_vector(self, data, output_lang):
+        counts = self.item_counts(data)
+        return [counts["tp"], counts["fp"], counts["fn"]]
+
+    def vector_statistic(self, sums):
+        import numpy as np
+        tp, fp, fn = sums[:, 0], sums[:, 1], sums[:, 2]
+        return np.where(tp > 0, 2 * tp / np.maximum(2 * tp + fp + fn, 1), 0.0)
 
 
 class EMEvaluator(Evaluator):
     def item_calculate(self, data, record, output_lang):
-        predictions = data['model_output']
-        references = data['reference']
-        item_score = self.metric.compute(predictions=predictions, references=references)['exact_match']
+        # 全サンプルのうち参照と完全一致した割合
+        predictions = self.output_texts(data)
+        item_score = self.metric(predictions, [data['reference']] * len(predictions))
         self.item_scores.append(item_score)
 
         return item_score
-    
-    def total_calculate(self, dataset, record, output_lang):
-        if self.item_scores:
-            total_score = sum(self.item_scores) / len(self.item_scores)
-        else:
-            total_score = 0.00
-        return total_score
 
 
 # =====================
@@ -254,11 +472,12 @@ class EvaluatorLoaderFactory:
     metric_pathに応じて適切なEvaluatorクラスをロードする。
     """
     @staticmethod
-    def create(metric_path, metric_args):
+    def create(metric_path, metric_args, cache_dir=None, execution_workers=None):
         if metric_path == "test":
             return TestEvaluator(metric_path, metric_args)
         elif metric_path == "code_eval":
-            return CodeEvalEvaluator(metric_path, metric_args)
+            execution_cache = load_execution_cache(cache_dir) if cache_dir is not None else None
+            return CodeEvalEvaluator(metric_path, metric_args, execution_cache, execution_workers)
         elif metric_path == "accuracy":
             return AccuracyEvaluator(metric_path, metric_args)
         elif metric_path == "bleu":
@@ -276,8 +495,39 @@ class EvaluatorLoaderFactory:
 # Utility Function
 # =====================
 
-def load_evaluator(metric_path, metric_args):
+def load_evaluator(metric_path, metric_args, cache_dir=None, execution_workers=None):
+    """Loads the evaluator; `cache_dir` enables the persistent execution cache (None disables it).
+
+    `execution_workers` is the default number of code execution processes (all CPU cores if None).
+    """
     if metric_path:
-        return EvaluatorLoaderFactory.create(metric_path, metric_args)
+        return EvaluatorLoaderFactory.create(metric_path, metric_args, cache_dir, execution_workers)
     else:
-        return False
\ No newline at end of file
+        return False
+
+
+def metric_paths(metric_path):
+    """Returns the metric path(s) given on the command line or in the config as a list."""
+    if not metric_path:
+        return []
+    return [metric_path] if isinstance(metric_path, str) else list(metric_path)
+
+
+def load_evaluators(metric_path, metric_args, cache_dir=None, execution_workers=None):
+    """
+    Loads one evaluator per metric and returns {metric_path: evaluator} in the given order.
+    With several metrics, `metric_args` may be keyed by metric path to pass different arguments.
+    """
+    paths = metric_paths(metric_path)
+    per_metric = isinstance(metric_args, dict) and len(paths) > 1 and metric_args and all(key in paths for key in metric_args)
+    evaluators = {}
+    for path in paths:
+        args = metric_args.get(path) if per_metric else metric_args
+        evaluators[path] = load_evaluator(path, args, cache_dir, execution_workers)
+    return evaluators
+
+
+def close_evaluators(evaluators):
+    for evaluator in evaluators.values():
+        evaluator.close()
+
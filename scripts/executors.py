@@ -0,0 +1,221 @@
+import builtins
+import faulthandler
+import importlib
+import multiprocessing
+import os
+import resource
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+
+# Standard library modules that candidate programs commonly import.
+# They are imported once in each worker, so forked candidates find them in sys.modules.
+PREIMPORT_MODULES = [
+    "math", "re", "itertools", "collections", "functools", "heapq", "bisect", "string",
+    "typing", "random", "statistics", "fractions", "decimal", "operator", "copy",
+    "hashlib", "datetime", "json", "unittest",
+]
+
+# Extra wall-clock time given to a candidate before the worker kills it
+KILL_GRACE_SECONDS = 0.5
+# Exit code of a child that ran its program to the end. Not 0, so that a candidate that calls
+# os._exit(0) before its tests run is not counted as passed.
+PASSED_EXIT_CODE = 117
+
+
+# =====================
+# Forked Candidate Execution
+# =====================
+
+def preimport_modules():
+    """Initializer of the worker processes: imports the common modules once."""
+    for name in PREIMPORT_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def apply_limits(timeout, memory_limit_mb):
+    """Applies CPU-time, memory and wall-clock limits to the current (forked) process."""
+    cpu_seconds = int(timeout) + 1
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds))
+    if memory_limit_mb:
+        memory_bytes = int(memory_limit_mb * 1024 * 1024)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    # SIGALRM の既定の動作でプロセスを終了させる
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+
+
+def reliability_guard():
+    """
+    Disables functions that could harm the machine or the worker (the same guard as human-eval and
+    evaluate's code_eval). Applied in the forked child only. This is not a security sandbox.
+    """
+    faulthandler.disable()
+
+    builtins.exit = None
+    builtins.quit = None
+    builtins.help = None
+
+    os.environ["OMP_NUM_THREADS"] = "1"
+    for name in [
+        "kill", "system", "putenv", "remove", "removedirs", "rmdir", "fchdir", "setuid", "fork", "forkpty",
+        "killpg", "rename", "renames", "truncate", "replace", "unlink", "fchmod", "fchown", "chmod", "chown",
+        "chroot", "lchflags", "lchmod", "lchown", "getcwd", "chdir",
+    ]:
+        if hasattr(os, name):
+            setattr(os, name, None)
+
+    shutil.rmtree = None
+    shutil.move = None
+    shutil.chown = None
+
+    subprocess.Popen = None
+
+    for name in ["ipdb", "joblib", "resource", "psutil", "tkinter"]:
+        sys.modules[name] = None
+
+
+def run_candidate(program, work_dir, timeout, memory_limit_mb):
+    """Body of the forked child: runs the program and exits with PASSED_EXIT_CODE if it passed. Never returns."""
+    status = 1
+    try:
+        os.setsid()
+        apply_limits(timeout, memory_limit_mb)
+        os.chdir(work_dir)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        reliability_guard()
+        exec(compile(program, "<candidate>", "exec"), {"__name__": "__main__"})
+        # 最後まで実行された場合のみ成功とする (exit() や sys.exit(0) でテストを飛ばしても失敗)
+        status = PASSED_EXIT_CODE
+    except BaseException:
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def wait_child(pid, timeout):
+    """Waits for the child up to `timeout` seconds and returns its wait status (None on timeout)."""
+    if hasattr(os, "pidfd_open"):
+        # Linux: 終了をポーリングせずに待つ
+        pidfd = os.pidfd_open(pid)
+        try:
+            ready, _, _ = select.select([pidfd], [], [], timeout)
+        finally:
+            os.close(pidfd)
+        if not ready:
+            return None
+        return os.waitpid(pid, 0)[1]
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        finished_pid, status = os.waitpid(pid, os.WNOHANG)
+        if finished_pid:
+            return status
+        time.sleep(0.001)
+    return None
+
+
+def run_forked(program, timeout, memory_limit_mb):
+    """Runs one program in a child forked from this worker and returns whether it passed."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            run_candidate(program, work_dir, timeout, memory_limit_mb)
+
+        status = wait_child(pid, timeout + KILL_GRACE_SECONDS)
+        if status is None:
+            os.killpg(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        passed = status is not None and os.waitstatus_to_exitcode(status) == PASSED_EXIT_CODE
+        # 候補コードが生成した子プロセスも含めて停止する
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        return passed
+
+
+def run_chunk(programs, timeout, memory_limit_mb):
+    """Runs a chunk of programs in one worker (amortizes the inter-process round trip)."""
+    return [run_forked(program, timeout, memory_limit_mb) for program in programs]
+
+
+# =====================
+# Sandboxed Execution Pool
+# =====================
+
+class ExecutionPool:
+    """
+    Runs untrusted candidate programs in parallel and reports which of them passed.
+
+    `num_workers` long-lived worker processes act as fork servers: each one imports the common
+    standard library modules once and forks a fresh child per candidate, so a candidate pays
+    neither interpreter startup nor those imports. Every child runs in its own session and
+    temporary directory with CPU/memory rlimits and a wall-clock timeout.
+    A program passes only if it runs to the end within the timeout: an exception (SystemExit included)
+    or an early os._exit counts as a failure.
+    """
+    def __init__(self, num_workers=None, timeout=3.0, memory_limit_mb=1024):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        # ワーカーは最初の実行時に起動する (採点しないプロセスではプロセスを作らない)
+        self.executor = None
+
+    def run(self, programs: list) -> list:
+        """Executes all programs and returns a list of booleans (passed or not) in the same order."""
+        if not programs:
+            return []
+        chunksize = max(1, len(programs) // (self.num_workers * 4))
+        results = self.run_chunks(programs, chunksize)
+        # ワーカーが停止した場合 (候補コードがワーカーを kill した場合など) は、実行できなかった候補を
+        # 作り直したプールで1つずつ実行し直す。それでもプールを停止させた候補は失敗とする
+        for i, result in enumerate(results):
+            if result is None:
+                results[i] = bool(self.run_chunks([programs[i]], 1)[0])
+        return results
+
+    def run_chunks(self, programs, chunksize):
+        """Runs the programs in chunks; candidates lost to a broken pool are None and the pool is restarted."""
+        if self.executor is None:
+            # ワーカーはスレッドを持つ親プロセスから fork せず、spawn で起動する
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=preimport_modules,
+            )
+        run_program = partial(run_chunk, timeout=self.timeout, memory_limit_mb=self.memory_limit_mb)
+        chunks = [programs[i:i + chunksize] for i in range(0, len(programs), chunksize)]
+        futures = [self.executor.submit(run_program, chunk) for chunk in chunks]
+        results = []
+        broken = False
+        for chunk, future in zip(chunks, futures):
+            try:
+                results.extend(future.result())
+            except BrokenProcessPool:
+                broken = True
+                results.extend([None] * len(chunk))
+        if broken:
+            self.close()
+        return results
+
+    def close(self):
+        """Stops the worker processes (they are not daemonic: an exiting process would wait for them forever)."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
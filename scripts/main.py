@@ -3,14 +3,21 @@ import time
 import yaml
 import argparse
 import json
-import argparse
+import multiprocessing
+import urllib.error
+import urllib.request
 from tqdm import tqdm
-from config_utils import parse_args_and_config, load_config
-from results_handling import load_existing_results, group_and_aggregate_results, find_id_value, find_unprocessed_data, save_results
-from models import load_model
+from config_utils import parse_args_and_config, load_config, JOB_ARGS
+from results_handling import load_existing_results, group_and_aggregate_results, load_processed_ids, find_unprocessed_data, save_summary, load_result_writer, shard_result_path, merge_shard_results, load_state, save_state, metric_view, row_id, is_database, SQLiteResultStore
+from models import load_model, make_batches, CachedModel
+from caches import load_generation_cache, DEFAULT_CACHE_DIR
 from dataloaders import load_testdata
 from templates import load_template
-from evaluators import load_evaluator
+from evaluators import load_evaluators, close_evaluators
+from stages import StagePipeline
+
+# Maximum number of batches waiting between two pipeline stages
+PIPELINE_QUEUE_SIZE = 2
 
 
 def debug_print(debug_mode, *messages):
@@ -19,9 +26,8 @@ def debug_print(debug_mode, *messages):
         print("🐥", *messages)
         
 
-def main():
-    args = parse_args_and_config()
-
+def build_model(args, template=None):
+    """Loads the model (wrapped with the generation cache unless disabled) and binds the template."""
     debug_mode = args.debug_mode
     quantize = args.quantize_model
     debug_print(debug_mode, "Quantization:\n", quantize)
@@ -29,56 +35,291 @@ def main():
     model = load_model(args.model_path, args.openai_api_key, args.aws_access_key_id, args.aws_secret_access_key, args.hf_token, args.model_args, quantize)
     debug_print(debug_mode, "Model loaded:\n", model)
 
-    dataset = load_testdata(args.dataset_path, args.dataset_args)
-    debug_print(args.debug_mode, "Dataset loaded:\n", len(dataset), "entries")
+    if not args.no_cache:
+        generation_cache = load_generation_cache(args.cache_dir, args.cache_max_size)
+        model = CachedModel(model, generation_cache, args.model_path)
+        debug_print(debug_mode, "Generation cache:\n", generation_cache.cache_path)
 
-    template = load_template(args.template_path)
-    evaluator = load_evaluator(args.metric_path, args.metric_args)
+    if template:
+        model.bind_template(template)
+    return model
 
-    record = {
+
+def build_evaluators(args, execution_workers=None):
+    """Loads {metric_path: evaluator}, with the persistent execution cache unless caching is disabled."""
+    cache_dir = None if args.no_cache else (args.cache_dir or DEFAULT_CACHE_DIR)
+    return load_evaluators(args.metric_path, args.metric_args, cache_dir, execution_workers)
+
+
+def build_record(args):
+    return {
         'model': args.model_path,
         'dataset': args.dataset_path,
         'template': args.template_path,
         'metrics': args.metric_path,
     }
 
-    loaded_results = load_existing_results(args.result_path)
-    existing_results = group_and_aggregate_results(loaded_results)
-    unprocessed_data = find_unprocessed_data(dataset, existing_results)
 
-    for data in tqdm(unprocessed_data):
-            
+def process_data(args, model, template, evaluators, data_list, result_path, position=0):
+    """Generates, collates and scores `data_list`, appending the results to `result_path`."""
+    debug_mode = args.debug_mode
+    record = build_record(args)
+
+    prompts = []
+    for data in data_list:
         prompt = template.process(data)
         data['reference'] = template.process_reference(data)
         data['model_input'] = prompt
-        debug_print(debug_mode, "Input:\n", data['model_input'])
-        data['model_output'] = model.generate(prompt)
-        debug_print(debug_mode, "Output_Sample:\n", data['model_output'][0])
-        output_lang, output_format, formatted_output_list, format_checked_list = template.collate(prompt, data['model_output'])
-        data['output_format'] = output_format
-
-        if format_checked_list:
-            data['format_checked'] = format_checked_list
-        
-        data['formatted_output'] = formatted_output_list
-        debug_print(debug_mode, "Formatted_Sample:\n", data['formatted_output'][0])
+        prompts.append(prompt)
+
+    batches = make_batches(model, prompts, args.batch_size, args.max_batch_tokens)
+    debug_print(debug_mode, "Batches:\n", len(batches), "batches")
 
-        if evaluator:
+    output_lang = template.template_data.get('output_lang', '')
+    progress = tqdm(total=len(data_list), position=position)
+
+    # 生成 → 整形 → 採点 → 書き込みを別スレッドで並行に実行し、
+    # バッチ N の採点中にバッチ N+1 を生成できるようにする
+    def generate_stage(batch_data):
+        for data in batch_data:
+            debug_print(debug_mode, "Input:\n", data['model_input'])
+        model_outputs = model.generate_batch([data['model_input'] for data in batch_data])
+        for data, model_output in zip(batch_data, model_outputs):
+            data['model_output'] = model_output
+            debug_print(debug_mode, "Output_Sample:\n", data['model_output'][0])
+        return batch_data
+
+    def collate_stage(batch_data):
+        for data in batch_data:
+            _, output_format, formatted_output_list, format_checked_list = template.collate(data['model_input'], data['model_output'])
+            data['output_format'] = output_format
+
+            if format_checked_list:
+                data['format_checked'] = format_checked_list
+
+            data['formatted_output'] = formatted_output_list
+            debug_print(debug_mode, "Formatted_Sample:\n", data['formatted_output'][0])
+        return batch_data
+
+    def score_stage(batch_data):
+        # バッチ内のアイテムはまとめて採点する (code_eval では全候補を並列に実行する)
+        # 評価指標が複数ある場合も、同じ整形済み出力をすべての評価器で採点する
+        scored_data = []
+        for data in batch_data:
+            data['item_scores'] = {}
             if data['formatted_output'] is None:
-                data['item_score'] = 0.0
+                data['item_scores'] = {metric_path: 0.0 for metric_path in evaluators}
             else:
-                data['item_score'] = evaluator.item_calculate(data, record, output_lang)
-                debug_print(debug_mode, "Score:\n", data['item_score'])
+                scored_data.append(data)
+        for metric_path, evaluator in evaluators.items():
+            item_scores = evaluator.batch_calculate(scored_data, record, output_lang)
+            for data, item_score in zip(scored_data, item_scores):
+                data['item_scores'][metric_path] = item_score
+        for data in batch_data:
+            data['item_score'] = data['item_scores'][primary_metric]
+            debug_print(debug_mode, "Score:\n", data['item_scores'])
+        return batch_data
+
+    def write_stage(batch_data):
+        writer.write(batch_data)
+        progress.update(len(batch_data))
+        return batch_data
+
+    primary_metric = next(iter(evaluators), None)
+    stages = [("generate", generate_stage), ("collate", collate_stage)]
+    if evaluators:
+        stages.append(("score", score_stage))
+    stages.append(("write", write_stage))
+
+    pipeline = StagePipeline(stages, queue_size=PIPELINE_QUEUE_SIZE)
+    writer = load_result_writer(result_path, record, args.commit_interval, args.fsync_interval)
+    try:
+        pipeline.run([data_list[i] for i in batch] for batch in batches)
+    finally:
+        writer.close()
+        progress.close()
+    return data_list
+
+
+def run_worker(args, shard, result_path, position):
+    """Entry point of a worker process: loads its own model replica and processes one shard."""
+    template = load_template(args.template_path)
+    model = build_model(args, template)
+    # コード実行のプロセス数は CPU コアをワーカー間で分ける
+    evaluators = build_evaluators(args, max(1, (os.cpu_count() or 1) // args.num_workers))
+    try:
+        process_data(args, model, template, evaluators, shard, result_path, position)
+    finally:
+        close_evaluators(evaluators)
+
+
+def run_workers(args, unprocessed_data):
+    """Shards the data across worker processes and merges their results into `args.result_path`."""
+    num_workers = min(args.num_workers, len(unprocessed_data))
+    # 各ワーカーのスレッド数が CPU コア数を奪い合わないようにする
+    os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // num_workers)))
+
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for i in range(num_workers):
+        shard = unprocessed_data[i::num_workers]
+        # データベースには全ワーカーが同時に書き込めるため、シャードに分けない
+        shard_path = args.result_path if is_database(args.result_path) else shard_result_path(args.result_path, i)
+        process = context.Process(target=run_worker, args=(args, shard, shard_path, i))
+        process.start()
+        processes.append(process)
 
-        save_results(args.result_path, [data], record)
+    for process in processes:
+        process.join()
+    # 失敗したワーカーがあっても、完了した分の結果はマージしてから中断する
+    merged_results = merge_shard_results(args.result_path)
+    failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Worker processes {failed} failed. Completed items were merged into {args.result_path}; rerun to resume.")
+    if is_database(args.result_path):
+        shard_ids = {row_id(data) for data in unprocessed_data}
+        merged_results = [result for result in load_existing_results(args.result_path) if result.get('id') in shard_ids]
+    return group_and_aggregate_results(merged_results)
+
+
+def run_job(args, model=None):
+    """Runs one evaluation job and returns the total score (None without a metric).
+
+    If `model` is given (server mode), it is reused instead of loading a new one.
+    """
+    debug_mode = args.debug_mode
+
+    dataset = load_testdata(args.dataset_path, args.dataset_args)
+    debug_print(args.debug_mode, "Dataset loaded:\n", len(dataset), "entries")
+
+    template = load_template(args.template_path)
+    evaluators = build_evaluators(args)
+    record = build_record(args)
+
+    try:
+        # 前回中断したワーカーの結果が残っていれば先にマージする
+        merge_shard_results(args.result_path)
+        # 再開時は索引から処理済みの id だけを読み込む (結果の行は集計で必要になった場合のみ読み込む)
+        processed_ids = load_processed_ids(args.result_path)
+        unprocessed_data = find_unprocessed_data(dataset, processed_ids=processed_ids)
+
+        if model is None and args.num_workers > 1 and len(unprocessed_data) > 1:
+            debug_print(debug_mode, "Workers:\n", args.num_workers)
+            processed_data = run_workers(args, unprocessed_data)
+        else:
+            if model is None:
+                model = build_model(args, template)
+            else:
+                model.bind_template(template)
+            processed_data = process_data(args, model, template, evaluators, unprocessed_data, args.result_path)
     
-    if evaluator:
-        if 'output_lang' not in locals():
-            raise ValueError("output_lang is not defined. Cannot execute as all data has already been processed.")
+        if evaluators:
+            output_lang = template.template_data.get('output_lang', '')
+            all_results = []
+
+            def load_all_results():
+                """Loads (once) every item of the result file, including the ones processed now."""
+                if not all_results:
+                    all_results.extend(group_and_aggregate_results(load_existing_results(args.result_path)))
+                return all_results
+
+            total_scores = {}
+            for metric_path, evaluator in evaluators.items():
+                total_scores[metric_path] = aggregate(
+                    args, metric_path, evaluator, len(processed_ids), processed_data, load_all_results, record, output_lang
+                )
+            total_score = next(iter(total_scores.values()))
+            if is_database(args.result_path):
+                # 他のプロセスが同じデータベースに書き込んだアイテムも数える
+                num_items = len(load_processed_ids(args.result_path))
+            else:
+                num_items = len(processed_ids) + len(processed_data)
+            # 結果ファイルは書き換えず、全体スコアはサマリーファイルに保存する
+            if len(total_scores) == 1:
+                save_summary(args.result_path, record, num_items, total_score)
+                return total_score
+            save_summary(args.result_path, record, num_items, total_score, total_scores)
+            return total_scores
+        return None
+    finally:
+        # コード実行のワーカープロセスを停止する (サーバーモードではジョブごとに作られる)
+        close_evaluators(evaluators)
+
+
+def aggregate(args, metric_path, evaluator, num_existing, processed_data, load_all_results, record, output_lang):
+    """Calculates the total score, folding only the new items into the persisted running state.
+
+    The result file is read (through `load_all_results`) only if the state is missing, was made
+    for other metric arguments or does not cover exactly the `num_existing` earlier items,
+    or if the evaluator has no running state.
+    A result database may also be written by other processes, so its state is always computed
+    from the database (with SQL when the evaluator supports it) instead of the state file.
+    """
+    state = evaluator.init_state()
+    if state is None:
+        all_data = [metric_view(data, metric_path) for data in load_all_results()]
+        return evaluator.total_calculate(all_data, record, output_lang)
+
+    if is_database(args.result_path):
+        with SQLiteResultStore(args.result_path) as store:
+            queried_state = evaluator.query_state(store, metric_path)
+        if queried_state is not None:
+            return evaluator.finalize(queried_state)
+        for data in load_all_results():
+            state = evaluator.update_state(state, metric_view(data, metric_path), output_lang)
+        return evaluator.finalize(state)
+
+    key = {"metric_args": evaluator.metric_args, "output_lang": output_lang}
+    saved_state, num_items = load_state(args.result_path, metric_path, key)
+    if saved_state is not None and num_items == num_existing:
+        for data in processed_data:
+            state = evaluator.update_state(state, metric_view(data, metric_path), output_lang)
+        state = evaluator.merge_state(saved_state, state)
+        num_items = num_existing + len(processed_data)
+    else:
+        all_data = load_all_results()
+        debug_print(args.debug_mode, "Rebuilding aggregate state of", metric_path, "from", len(all_data), "results")
+        for data in all_data:
+            state = evaluator.update_state(state, metric_view(data, metric_path), output_lang)
+        num_items = len(all_data)
+    save_state(args.result_path, metric_path, key, state, num_items)
+    return evaluator.finalize(state)
+
+
+def submit_job(args):
+    """Sends the job to a running model server (see server.py) and returns its response."""
+    job = {}
+    for arg in JOB_ARGS:
+        value = getattr(args, arg, None)
+        if value is not None and value is not False:
+            job[arg] = value
+    # サーバーの作業ディレクトリに依存しないよう、ローカルのパスは絶対パスにする
+    for arg in ['dataset_path', 'template_path', 'result_path']:
+        if arg in job and (os.path.exists(job[arg]) or arg == 'result_path'):
+            job[arg] = os.path.abspath(job[arg])
+
+    request = urllib.request.Request(
+        args.server_url.rstrip('/') + '/jobs',
+        data=json.dumps(job).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"Model server rejected the job: {e.read().decode('utf-8')}") from e
+
+
+def main():
+    args = parse_args_and_config()
+
+    if args.server_url:
+        response = submit_job(args)
+        total_score = response.get('total_score')
+    else:
+        total_score = run_job(args)
 
-        all_data = existing_results + unprocessed_data
-        total_score = evaluator.total_calculate(all_data, record, output_lang)
-        save_results(args.result_path, all_data, record, total_score)
+    if total_score is not None:
         print("Total_score:\n", total_score)
 
 if __name__ == '__main__':
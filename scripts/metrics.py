@@ -0,0 +1,291 @@
+import math
+import re
+from collections import Counter
+import numpy as np
+
+
+# =====================
+# Classification / Matching
+# =====================
+
+def normalize_label(value):
+    """Compares labels as integers when possible (e.g. "1" and 1), otherwise as stripped strings."""
+    text = str(value).strip()
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def accuracy(predictions, references):
+    """Fraction of predictions equal to their reference label."""
+    if not predictions:
+        return 0.0
+    return sum(normalize_label(p) == normalize_label(r) for p, r in zip(predictions, references)) / len(predictions)
+
+
+def confusion_counts(predictions, references, pos_label=1):
+    """Returns {"tp", "fp", "fn"} of the positive label."""
+    counts = {"tp": 0, "fp": 0, "fn": 0}
+    for prediction, reference in zip(predictions, references):
+        predicted = normalize_label(prediction) == pos_label
+        actual = normalize_label(reference) == pos_label
+        if predicted and actual:
+            counts["tp"] += 1
+        elif predicted:
+            counts["fp"] += 1
+        elif actual:
+            counts["fn"] += 1
+    return counts
+
+
+def f1_from_counts(tp, fp, fn):
+    return 2 * tp / (2 * tp + fp + fn) if tp else 0.0
+
+
+def f1(predictions, references, pos_label=1):
+    """Binary F1 score of the positive label (same as the default of evaluate's / scikit-learn's f1)."""
+    counts = confusion_counts(predictions, references, pos_label)
+    return f1_from_counts(counts["tp"], counts["fp"], counts["fn"])
+
+
+def exact_match(predictions, references):
+    """Fraction of predictions that are exactly equal to their reference string."""
+    if not predictions:
+        return 0.0
+    return sum(str(p) == str(r) for p, r in zip(predictions, references)) / len(predictions)
+
+
+# =====================
+# pass@k
+# =====================
+
+def estimate_pass_at_k(num_samples, num_correct, k):
+    """
+    Computes the unbiased pass@k estimator (Chen et al., 2021) for every item at once.
+
+    pass@k = 1 - C(n - c, k) / C(n, k), where n is the number of samples and c the number of
+    correct samples of an item. Items may have different n. The binomial ratio is evaluated
+    in log space from a table of log-factorials. Items with fewer than k samples are NaN.
+    """
+    n = np.asarray(num_samples, dtype=np.int64)
+    c = np.asarray(num_correct, dtype=np.int64)
+    pass_at_k = np.full(n.shape, np.nan)
+    if n.size == 0:
+        return pass_at_k
+
+    log_factorial = np.concatenate([[0.0], np.cumsum(np.log(np.arange(1, n.max() + 1)))])
+
+    valid = n >= k
+    always_pass = valid & (n - c < k)
+    pass_at_k[always_pass] = 1.0
+
+    rest = valid & ~always_pass
+    n_rest = n[rest]
+    c_rest = c[rest]
+    log_ratio = (
+        log_factorial[n_rest - c_rest] + log_factorial[n_rest - k]
+        - log_factorial[n_rest - c_rest - k] - log_factorial[n_rest]
+    )
+    # 対数階乗の丸め誤差で c = 0 のときに負の値にならないよう [0, 1] に収める
+    pass_at_k[rest] = np.clip(1.0 - np.exp(log_ratio), 0.0, 1.0)
+    pass_at_k[rest & (c == 0)] = 0.0
+    return pass_at_k
+
+
+def mean_pass_at_k(num_samples, num_correct, ks, weights=None):
+    """
+    Returns {"pass@k": mean over items} for each k that at least one item has enough samples for.
+    `weights` gives the number of items sharing each (num_samples, num_correct) pair.
+    """
+    weights = np.ones(len(num_samples)) if weights is None else np.asarray(weights, dtype=np.float64)
+    scores = {}
+    for k in ks:
+        pass_at_k = estimate_pass_at_k(num_samples, num_correct, k)
+        valid = ~np.isnan(pass_at_k)
+        if valid.any():
+            scores[f"pass@{k}"] = float(np.average(pass_at_k[valid], weights=weights[valid]))
+    return scores
+
+
+# =====================
+# BLEU Tokenizers
+# =====================
+
+# sacrebleu の 13a トークナイザ (mteval-v13a.pl 相当) と同じ規則
+_13A_REGEXES = [
+    (re.compile(r"([\{-\~\[-\` -\&\(-\+\:-\@\/])"), r" \1 "),
+    (re.compile(r"([^0-9])([\.,])"), r"\1 \2 "),
+    (re.compile(r"([\.,])([^0-9])"), r" \1 \2"),
+    (re.compile(r"([0-9])(-)"), r"\1 \2 "),
+]
+
+
+def tokenize_13a(text):
+    """Tokenizes text with the 13a rules (the default tokenizer of sacrebleu and evaluate's bleu)."""
+    text = text.replace("<skipped>", "").replace("-\n", "").replace("\n", " ")
+    if "&" in text:
+        text = text.replace("&quot;", '"').replace("&amp;", "&").replace("&lt;", "<").replace("&gt;", ">")
+    text = f" {text} "
+    for regex, replacement in _13A_REGEXES:
+        text = regex.sub(replacement, text)
+    return text.split()
+
+
+# 日本語用のtokenizer
+# Python: 正規表現による簡易版形態素解析
+# https://qiita.com/kinoshita_yuri/items/e15f143981f1616994ed
+_JA_TOKEN = re.compile(r"/|[A-Z]+|[a-z]+|[ァ-ンー]+|[ぁ-ん-]+|[ァ-ヶ]+|[一-龍]+|[。、]|/")
+_JA_HIRAGANA = re.compile(r'^[あ-ん]+$')
+
+
+def tokenize_ja(text):
+    """Splits Japanese text into tokens by character class, separating common particles."""
+    tokens = []
+    for row in _JA_TOKEN.findall(text):
+        if _JA_HIRAGANA.fullmatch(row):
+            if row[0] in 'はがのにへともでを':
+                tokens.append(row[0])
+                if len(row) > 1:
+                    tokens.append(row[1:])
+            elif row[-2:] in 'のでからまで':
+                tokens.append(row[0:-2])
+                tokens.append(row[-2:])
+            elif row[-1:] in 'もはがでを':
+                tokens.append(row[0:-1])
+                tokens.append(row[-1:])
+            else:
+                tokens.append(row)
+        else:
+            tokens.append(row)
+    return tokens
+
+
+def load_tokenizer(output_lang):
+    return tokenize_ja if output_lang == 'ja' else tokenize_13a
+
+
+# =====================
+# BLEU
+# =====================
+
+def ngram_counts(tokens, max_order):
+    counts = Counter()
+    for order in range(1, max_order + 1):
+        for i in range(len(tokens) - order + 1):
+            counts[tuple(tokens[i:i + order])] += 1
+    return counts
+
+
+class BLEUStats:
+    """
+    Sufficient statistics of corpus BLEU: clipped n-gram matches, possible n-grams and lengths.
+
+    Sentences are added one at a time and statistics can be merged, so corpus BLEU over any set
+    of items is computed from the summed statistics without tokenizing the texts again.
+    The score follows the nmt BLEU used by evaluate's `bleu` (shortest reference length).
+    """
+    def __init__(self, max_order=4):
+        self.max_order = max_order
+        self.matches = [0] * max_order
+        self.possible = [0] * max_order
+        self.translation_length = 0
+        self.reference_length = 0
+
+    def add(self, prediction_tokens, references_tokens):
+        """Adds one tokenized prediction and its tokenized references."""
+        reference_counts = Counter()
+        for reference_tokens in references_tokens:
+            reference_counts |= ngram_counts(reference_tokens, self.max_order)
+        overlap = ngram_counts(prediction_tokens, self.max_order) & reference_counts
+        for ngram, count in overlap.items():
+            self.matches[len(ngram) - 1] += count
+        for order in range(1, self.max_order + 1):
+            self.possible[order - 1] += max(len(prediction_tokens) - order + 1, 0)
+        self.translation_length += len(prediction_tokens)
+        self.reference_length += min(len(reference_tokens) for reference_tokens in references_tokens)
+
+    def merge(self, other):
+        for i in range(self.max_order):
+            self.matches[i] += other.matches[i]
+            self.possible[i] += other.possible[i]
+        self.translation_length += other.translation_length
+        self.reference_length += other.reference_length
+        return self
+
+    def score(self, smooth=True):
+        if smooth:
+            precisions = [(m + 1.0) / (p + 1.0) for m, p in zip(self.matches, self.possible)]
+        else:
+            precisions = [m / p if p > 0 else 0.0 for m, p in zip(self.matches, self.possible)]
+        if min(precisions) <= 0 or self.translation_length == 0 or self.reference_length == 0:
+            return 0.0
+        geo_mean = math.exp(sum(math.log(p) for p in precisions) / self.max_order)
+        ratio = self.translation_length / self.reference_length
+        brevity_penalty = 1.0 if ratio > 1.0 else math.exp(1 - 1.0 / ratio)
+        return geo_mean * brevity_penalty
+
+    def to_dict(self):
+        return {
+            "matches": self.matches, "possible": self.possible,
+            "translation_length": self.translation_length, "reference_length": self.reference_length,
+        }
+
+    def to_vector(self):
+        return self.matches + self.possible + [self.translation_length, self.reference_length]
+
+    @classmethod
+    def from_dict(cls, stats):
+        bleu_stats = cls(max_order=len(stats["matches"]))
+        bleu_stats.matches = list(stats["matches"])
+        bleu_stats.possible = list(stats["possible"])
+        bleu_stats.translation_length = stats["translation_length"]
+        bleu_stats.reference_length = stats["reference_length"]
+        return bleu_stats
+
+
+def bleu_from_sums(sums, max_order=4, smooth=True):
+    """
+    Vectorized BLEU for many sets of summed statistics at once.
+
+    Each row of `sums` is [matches (max_order), possible (max_order), translation_length,
+    reference_length], i.e. the flattened BLEUStats of a (resampled) corpus.
+    """
+    sums = np.atleast_2d(np.asarray(sums, dtype=np.float64))
+    matches = sums[:, :max_order]
+    possible = sums[:, max_order:2 * max_order]
+    translation_length = sums[:, 2 * max_order]
+    reference_length = sums[:, 2 * max_order + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if smooth:
+            precisions = (matches + 1.0) / (possible + 1.0)
+        else:
+            precisions = np.where(possible > 0, matches / np.where(possible > 0, possible, 1.0), 0.0)
+        geo_mean = np.exp(np.log(precisions).mean(axis=1))
+        ratio = translation_length / reference_length
+        brevity_penalty = np.where(ratio > 1.0, 1.0, np.exp(1 - 1.0 / ratio))
+        bleu = geo_mean * brevity_penalty
+    valid = (precisions.min(axis=1) > 0) & (translation_length > 0) & (reference_length > 0)
+    return np.where(valid, bleu, 0.0)
+
+
+# =====================
+# Metric Registry
+# =====================
+
+# 組み込みの評価指標 (ネットワークや動的なモジュール読み込みを必要としない)
+METRICS = {
+    "accuracy": accuracy,
+    "f1": f1,
+    "exact_match": exact_match,
+    "bleu": BLEUStats,
+    "code_eval": estimate_pass_at_k,
+}
+
+
+def load_metric(metric_path):
+    """Returns the built-in implementation of the metric."""
+    if metric_path not in METRICS:
+        raise ValueError(f"Unknown metric path: {metric_path}. Available metrics are {list(METRICS)}.")
+    return METRICS[metric_path]
+
@@ -1,22 +1,39 @@
-import torch
 import os
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline, BitsAndBytesConfig
-import openai
-from openai import OpenAI
+import copy
 import json
-import boto3
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# torch / transformers / openai / boto3 are imported inside each backend,
+# so that only the selected backend pays its import time.
+
 # =====================
 # Base Classes
 # =====================
 
 class Model:
     """Base class for abstracting a pretrained model."""
+    stop_sequences = []
+    # Options outside model_args that change the outputs (part of the generation cache key)
+    cache_args = {}
+    # Number of prompts per generation call when batch_size is not given
+    default_batch_size = 1
+
     def generate(self, prompt: str)->str:
         return f"Generated response for: {prompt}"
 
+    def generate_batch(self, prompts: list) -> list:
+        """Generates outputs for a group of prompts, returning one output list per prompt in order."""
+        return [self.generate(prompt) for prompt in prompts]
+
+    def count_tokens(self, prompt: str) -> int:
+        """Roughly estimates the number of tokens in a prompt (used for batch budgeting)."""
+        return len(prompt.split())
+
+    def bind_template(self, template):
+        """Receives the template used for the run, so that backends can prepare for its prompts."""
+        pass
+
 
 class ModelLoader:
     """Loads a Model instance based on a model name and additional arguments."""
@@ -61,8 +78,37 @@ class TestModelLoader(ModelLoader):
 # HuggingFace Model Integration
 # =====================
 
+class StopSequenceCriteria:
+    """Stops each sequence once its generated text contains one of the stop sequences.
+
+    Only the newly generated tokens are checked, and only a short tail of them per step.
+    A new instance must be used for every generate call. (Implements the transformers
+    StoppingCriteria interface without subclassing it, to keep transformers a lazy import.)
+    Returns one flag per row, which requires transformers >= 4.39 (pinned in requirements.txt).
+    """
+    def __init__(self, tokenizer, stop_sequences):
+        self.tokenizer = tokenizer
+        self.stop_sequences = stop_sequences
+        self.window = max(len(seq) for seq in stop_sequences) + 8
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        if self.prompt_length is None:
+            # 最初の呼び出しは1トークン生成した直後
+            self.prompt_length = input_ids.shape[1] - 1
+        start = max(self.prompt_length, input_ids.shape[1] - self.window)
+        tails = self.tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+        is_done = [any(seq in tail for seq in self.stop_sequences) for tail in tails]
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+
 class HFModel(Model):
     def __init__(self, model_name, hf_token=None, model_args=None, quantize=False):
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline, BitsAndBytesConfig
+
         default_args = {
             "max_length": 512,
             "do_sample": True,
@@ -71,12 +117,23 @@ class HFModel(Model):
             "return_full_text": False,
             "num_return_sequences": 1,
         }
-        model_args = model_args or {}
+        model_args = dict(model_args or {})
         if "max_new_tokens" in model_args:
             default_args.pop("max_length", None)
+        # テンプレートの共通プレフィックスの KV キャッシュを再利用するか
+        self.prefix_cache = model_args.pop("prefix_cache", False)
+        # "generate": model.generate を直接呼ぶ / "pipeline": transformers の pipeline を使う
+        self.backend = model_args.pop("backend", "generate")
+        if self.backend == "pipeline":
+            # pipeline はプロンプトを文字列で受け取るため、プレフィックスキャッシュは使えない
+            self.prefix_cache = False
+        static_cache = model_args.pop("static_cache", False)
         default_args.update(model_args)
 
-        # super().__init__()
+        self.prompt_prefix = ""
+        self.prefix_ids = None
+        self.prefix_past = None
+
         # Initialize the tokenizer
         self.tokenizer = AutoTokenizer.from_pretrained(
             model_name, 
@@ -85,21 +142,13 @@ class HFModel(Model):
             padding_side='left'
         )
         self.tokenizer.pad_token = self.tokenizer.eos_token
-        
-        # pipelineなしで実装----------------------------------
-        # # Initialize the model
-        # self.model = AutoModelForCausalLM.from_pretrained(
-        #     model_name, 
-        #     use_auth_token=hf_token if hf_token else None,
-        #     trust_remote_code=True
-        # )
-
-        # # Set the device to GPU if available
-        # self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        # self.model.to(self.device)
-        # ----------------------------------
 
         self.model_args = default_args
+        self.cache_args = {"quantize": bool(quantize)}
+        # Arguments for model.generate (return_full_text is handled when decoding)
+        self.generate_args = {k: v for k, v in self.model_args.items() if k != "return_full_text"}
+        if static_cache:
+            self.generate_args["cache_implementation"] = "static"
 
         if quantize:
             bnb_config = BitsAndBytesConfig(
@@ -115,9 +164,6 @@ class HFModel(Model):
                 trust_remote_code=True,
                 use_auth_token=hf_token if hf_token else None,
             )
-            # self.model = AutoModelForCausalLM.from_pretrained(
-            #     model_name, device_map="auto", use_auth_token=hf_token if hf_token else None, load_in_4bit=True
-            # )
         else:
             self.model = AutoModelForCausalLM.from_pretrained(
                 model_name, 
@@ -125,26 +171,156 @@ class HFModel(Model):
                 trust_remote_code=True,
                 device_map="auto",
             )
-
-        self.generator = pipeline(
-            "text-generation",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            # device=0 if torch.cuda.is_available() else -1,
-            use_auth_token=hf_token if hf_token else None,
-            **self.model_args
-        )
+        self.model.eval()
+
+        self.generator = None
+        if self.backend == "pipeline":
+            self.generator = pipeline(
+                "text-generation",
+                model=self.model,
+                tokenizer=self.tokenizer,
+                use_auth_token=hf_token if hf_token else None,
+            )
+        elif self.backend != "generate":
+            raise ValueError(f"Unknown HF backend: {self.backend}")
 
     
     def generate(self, prompt: str) -> list:
-        # pipelineなしで実装----------------------------------
-        # input_ids = self.tokenizer.encode(prompt, return_tensors="pt").to(self.device)
-        # generated_ids = self.model.generate(input_ids, **self.model_args)
-        # return self.tokenizer.decode(generated_ids[0], skip_special_tokens=True)
-        # ----------------------------------
-        generated_texts = self.generator(prompt, **self.model_args, pad_token_id=self.generator.tokenizer.eos_token_id)
-        generated_texts_list = [item['generated_text'] for item in generated_texts]
-        return generated_texts_list
+        return self.generate_batch([prompt])[0]
+
+    def generate_batch(self, prompts: list) -> list:
+        if self.backend == "pipeline":
+            return self.generate_with_pipeline(prompts)
+        suffix_ids = self.split_prefix_ids(prompts)
+        if suffix_ids is not None:
+            return self.generate_with_prefix(prompts, suffix_ids)
+        import torch
+
+        # padding_side='left' と pad_token の設定により、複数プロンプトをまとめて生成できる
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        with torch.no_grad():
+            generated_ids = self.model.generate(
+                input_ids=inputs.input_ids,
+                attention_mask=inputs.attention_mask,
+                pad_token_id=self.tokenizer.eos_token_id,
+                **self.generate_args,
+                **self.stopping_args()
+            )
+        # 生成された部分のトークンのみをデコードする
+        generated_texts = self.tokenizer.batch_decode(generated_ids[:, inputs.input_ids.shape[1]:], skip_special_tokens=True)
+        num_sequences = self.model_args.get("num_return_sequences", 1)
+        return [
+            self.finish_texts(prompt, generated_texts[i * num_sequences:(i + 1) * num_sequences])
+            for i, prompt in enumerate(prompts)
+        ]
+
+    def generate_with_pipeline(self, prompts: list) -> list:
+        generated_batches = self.generator(
+            prompts,
+            batch_size=len(prompts),
+            **self.model_args,
+            **self.stopping_args(),
+            pad_token_id=self.tokenizer.eos_token_id
+        )
+        return [[item['generated_text'] for item in generated_texts] for generated_texts in generated_batches]
+
+    def finish_texts(self, prompt: str, generated_texts: list) -> list:
+        if self.model_args.get("return_full_text"):
+            return [prompt + text for text in generated_texts]
+        return generated_texts
+
+    def count_tokens(self, prompt: str) -> int:
+        return len(self.tokenizer(prompt)['input_ids'])
+
+    def stopping_args(self) -> dict:
+        """Returns generate kwargs that stop at the template's stop sequences (kept in the output)."""
+        if not self.stop_sequences:
+            return {}
+        from transformers import StoppingCriteriaList
+        return {"stopping_criteria": StoppingCriteriaList([StopSequenceCriteria(self.tokenizer, self.stop_sequences)])}
+
+    def bind_template(self, template):
+        self.stop_sequences = template.stop_sequences()
+        prompt_prefix = template.static_prefix() if self.prefix_cache else ""
+        if prompt_prefix != self.prompt_prefix:
+            self.prompt_prefix = prompt_prefix
+            self.prefix_ids = None
+            self.prefix_past = None
+
+    # プレフィックスキャッシュ----------------------------------
+    def split_prefix_ids(self, prompts: list):
+        """
+        Tokenizes the full prompts and returns the token ids following the cached prefix for each one,
+        or None if the shared-prefix KV cache cannot be used for these prompts.
+        """
+        if not self.prompt_prefix or self.model_args.get("num_beams", 1) != 1:
+            return None
+        if not all(prompt.startswith(self.prompt_prefix) for prompt in prompts):
+            return None
+        if self.prefix_ids is None:
+            self.prefix_ids = self.tokenizer(self.prompt_prefix, return_tensors="pt").input_ids.to(self.model.device)
+        prefix_ids = self.prefix_ids[0].tolist()
+        suffix_ids = []
+        for ids in self.tokenizer(prompts)["input_ids"]:
+            # プロンプト全体のトークン列がプレフィックスのトークン列で始まる場合のみ使う
+            # (境界でトークンが結合されたり、sentencepiece の "▁" が付いたりすると入力が変わるため)
+            if len(ids) <= len(prefix_ids) or ids[:len(prefix_ids)] != prefix_ids:
+                return None
+            suffix_ids.append(ids[len(prefix_ids):])
+        return suffix_ids
+
+    def build_prefix_cache(self):
+        """Runs the prefill for the static template prefix once and keeps its past-key-values."""
+        import torch
+        from transformers import DynamicCache
+
+        with torch.no_grad():
+            outputs = self.model(self.prefix_ids, past_key_values=DynamicCache(), use_cache=True)
+        self.prefix_past = outputs.past_key_values
+
+    def generate_with_prefix(self, prompts: list, suffix_ids: list) -> list:
+        """Generates the whole batch at once, starting from the prefix cache expanded to the batch size."""
+        import torch
+
+        if self.prefix_past is None:
+            self.build_prefix_cache()
+
+        num_sequences = self.model_args.get("num_return_sequences", 1)
+        batch_size = len(prompts) * num_sequences
+        device = self.model.device
+
+        # 接尾部分を左側でパディングし、パディングはアテンションマスクで除外する
+        max_length = max(len(ids) for ids in suffix_ids)
+        padded_ids = [[self.tokenizer.pad_token_id] * (max_length - len(ids)) + ids for ids in suffix_ids]
+        suffix_mask = [[0] * (max_length - len(ids)) + [1] * len(ids) for ids in suffix_ids]
+        suffix_ids = torch.tensor(padded_ids, device=device).repeat_interleave(num_sequences, dim=0)
+        suffix_mask = torch.tensor(suffix_mask, device=device).repeat_interleave(num_sequences, dim=0)
+        input_ids = torch.cat([self.prefix_ids.repeat(batch_size, 1), suffix_ids], dim=1)
+        attention_mask = torch.cat(
+            [torch.ones((batch_size, self.prefix_ids.shape[1]), dtype=suffix_mask.dtype, device=device), suffix_mask], dim=1
+        )
+
+        # プレフィックスのキャッシュを複製し、バッチ内の全サンプルで共有する
+        generate_args = {k: v for k, v in self.generate_args.items() if k not in ["num_return_sequences", "cache_implementation"]}
+        past_key_values = copy.deepcopy(self.prefix_past)
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+
+        with torch.no_grad():
+            generated_ids = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                pad_token_id=self.tokenizer.eos_token_id,
+                **generate_args,
+                **self.stopping_args()
+            )
+        generated_texts = self.tokenizer.batch_decode(generated_ids[:, input_ids.shape[1]:], skip_special_tokens=True)
+        return [
+            self.finish_texts(prompt, generated_texts[i * num_sequences:(i + 1) * num_sequences])
+            for i, prompt in enumerate(prompts)
+        ]
+    # ----------------------------------
 
 class HFModelLoader(ModelLoader):
     def __init__(self, model_name, hf_token=None, model_args=None, quantize=True):
@@ -162,6 +338,9 @@ class HFModelLoader(ModelLoader):
 
 class OpenAIModel(Model):
     def __init__(self, openai_api_key, model_name, model_args=None):
+        from openai import AsyncOpenAI
+        from dispatchers import AsyncDispatcher
+
         # Default arguments for OpenAI API
         default_args = {
             "temperature": 0.2,
@@ -169,27 +348,65 @@ class OpenAIModel(Model):
             "max_tokens": 512, 
             "n": 1}
         # Override defaults with any user-provided arguments
-        model_args = model_args or {}
+        model_args = dict(model_args or {})
+        # Request-engine options are not sent to the API
+        dispatcher_args = {
+            key: model_args.pop(key)
+            for key in ["max_in_flight", "requests_per_minute", "tokens_per_minute", "max_retries"]
+            if key in model_args
+        }
+        base_url = model_args.pop("base_url", None)
         default_args.update(model_args)
 
         super().__init__()
         self.openai_api_key = openai_api_key
         self.model_name = model_name
         self.model_args = default_args
-
-    def generate(self, prompt: str) -> list:
-        client = OpenAI(api_key=self.openai_api_key)
-        
-        response = client.chat.completions.create(
+        self.cache_args = {"base_url": base_url}
+        self.dispatcher = AsyncDispatcher(**dispatcher_args)
+        # 1回の呼び出しで同時リクエスト数を十分に上回るプロンプトを渡し、並列に送信する
+        self.default_batch_size = 4 * self.dispatcher.max_in_flight
+        # One pooled client for the whole run; retries are handled by the dispatcher
+        self.client = AsyncOpenAI(api_key=self.openai_api_key, base_url=base_url, max_retries=0)
+
+    def bind_template(self, template):
+        # OpenAI は一致した stop を出力から除くため、整形で切り捨てられる stop のみ渡す (最大4つ)
+        self.stop_sequences = template.stop_sequences(truncating_only=True)[:4]
+
+    async def request(self, prompt: str) -> list:
+        stop_args = {"stop": self.stop_sequences} if self.stop_sequences and "stop" not in self.model_args else {}
+        response = await self.client.chat.completions.create(
             model=self.model_name,
             messages=[{"role": "user", "content": prompt}],
-            **self.model_args
+            **self.model_args,
+            **stop_args
         )
-        # prompt_and_response = prompt + "\n" + response.choices[0].message.content
-        # return response.choices[0].message.content
         responses = [choice.message.content for choice in response.choices]
         return responses
 
+    def estimate_cost(self, prompt: str) -> int:
+        """Estimates the tokens a request consumes (prompt plus all requested completions)."""
+        return len(prompt) // 4 + self.model_args.get("max_tokens", 0) * self.model_args.get("n", 1)
+
+    def retry_after(self, error):
+        """Returns the delay before retrying `error`, or None if it should not be retried."""
+        import openai
+
+        if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+            response = getattr(error, "response", None)
+            retry_after = response.headers.get("retry-after") if response is not None else None
+            try:
+                return float(retry_after) if retry_after else 0.0
+            except ValueError:
+                return 0.0
+        return None
+
+    def generate(self, prompt: str) -> list:
+        return self.generate_batch([prompt])[0]
+
+    def generate_batch(self, prompts: list) -> list:
+        return self.dispatcher.run(self.request, prompts, self.estimate_cost, self.retry_after)
+
 class OpenAIModelLoader(ModelLoader):
     def __init__(self, openai_api_key, model_name, model_args=None):
         super().__init__(model_name, model_args)
@@ -206,6 +423,10 @@ class OpenAIModelLoader(ModelLoader):
 
 class AnthropicModel(Model):
     def __init__(self, aws_access_key_id, aws_secret_access_key, model_name, model_args=None):
+        import boto3
+        from botocore.config import Config
+        from dispatchers import ThreadPoolDispatcher
+
         # Default arguments for Anthropic Claude API
         default_args = {
             "max_tokens_to_sample": 512,
@@ -213,7 +434,13 @@ class AnthropicModel(Model):
             "top_p": 0.95,
         }
         # Override defaults with any user-provided arguments
-        model_args = model_args or {}
+        model_args = dict(model_args or {})
+        # Samples per prompt are produced by parallel requests, not sent to the API
+        self.num_samples = model_args.pop("num_return_sequences", None) or model_args.pop("n", None) or 1
+        model_args.pop("n", None)
+        max_workers = model_args.pop("max_workers", 8)
+        max_retries = model_args.pop("max_retries", 6)
+        region_name = model_args.pop("region_name", "ap-northeast-1")
         default_args.update(model_args)
 
         super().__init__()
@@ -221,6 +448,21 @@ class AnthropicModel(Model):
         self.aws_secret_access_key = aws_secret_access_key
         self.model_name = model_name
         self.model_args = default_args
+        self.cache_args = {"region_name": region_name, "num_samples": self.num_samples}
+
+        # One client for the whole run, with a connection pool sized to the thread pool.
+        # Throttling is retried by the dispatcher so that it can lower the concurrency.
+        self.bedrock = boto3.client("bedrock-runtime",
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                region_name=region_name,
+                config=Config(
+                    max_pool_connections=max_workers,
+                    retries={"total_max_attempts": 1, "mode": "standard"},
+                ),
+        )
+        self.dispatcher = ThreadPoolDispatcher(max_workers=max_workers, max_retries=max_retries)
+        self.default_batch_size = 4 * max_workers
     
     def check_and_append_claude_format(self, prompt: str) -> str:
         human_str = "\n\nHuman:"
@@ -234,27 +476,44 @@ class AnthropicModel(Model):
 
         return prompt
 
-    def generate(self, prompt: str) -> str:
-        bedrock = boto3.client("bedrock-runtime",
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-                region_name='ap-northeast-1'
-        )
+    def bind_template(self, template):
+        self.stop_sequences = template.stop_sequences()
 
+    def request(self, prompt: str) -> str:
         prompt = self.check_and_append_claude_format(prompt)
 
+        stop_args = {"stop_sequences": self.stop_sequences} if self.stop_sequences and "stop_sequences" not in self.model_args else {}
         body = json.dumps(
             {
                 "prompt": prompt,
-                # "prompt": "\n\nHuman: Tell me a funny joke about outer space\n\nAssistant:",
                 "anthropic_version": "bedrock-2023-05-31",
                 **self.model_args,
+                **stop_args,
             }
         )
 
-        response = bedrock.invoke_model(body=body, modelId=self.model_name)
+        response = self.bedrock.invoke_model(body=body, modelId=self.model_name)
         response_body = json.loads(response.get("body").read())
-        return response_body.get("completion")
+        completion = response_body.get("completion")
+        # 一致した stop は出力から除かれるため、整形で参照できるよう末尾に戻す
+        if response_body.get("stop_reason") == "stop_sequence" and response_body.get("stop"):
+            completion += response_body["stop"]
+        return completion
+
+    def is_throttled(self, error) -> bool:
+        from botocore.exceptions import ClientError
+
+        if isinstance(error, ClientError):
+            return error.response.get("Error", {}).get("Code") in ["ThrottlingException", "ServiceUnavailableException"]
+        return False
+
+    def generate(self, prompt: str) -> list:
+        return self.generate_batch([prompt])[0]
+
+    def generate_batch(self, prompts: list) -> list:
+        requests = [prompt for prompt in prompts for _ in range(self.num_samples)]
+        completions = self.dispatcher.run(self.request, requests, self.is_throttled)
+        return [completions[i:i + self.num_samples] for i in range(0, len(completions), self.num_samples)]
 
 class AnthropicModelLoader(ModelLoader):
     def __init__(self, aws_access_key_id, aws_secret_access_key, model_name, model_args=None):
@@ -267,6 +526,49 @@ class AnthropicModelLoader(ModelLoader):
         return AnthropicModel(self.aws_access_key_id, self.aws_secret_access_key, self.model_name, self.model_args)
 
 
+# =====================
+# Generation Cache
+# =====================
+
+class CachedModel(Model):
+    """Wraps a model so that outputs already generated for the same prompt are read from the cache."""
+    def __init__(self, model, cache, model_id):
+        super().__init__()
+        self.model = model
+        self.cache = cache
+        self.model_id = model_id
+        self.model_args = model.model_args
+        self.default_batch_size = model.default_batch_size
+
+    def count_tokens(self, prompt: str) -> int:
+        return self.model.count_tokens(prompt)
+
+    def bind_template(self, template):
+        self.model.bind_template(template)
+
+    def generate(self, prompt: str) -> list:
+        return self.generate_batch([prompt])[0]
+
+    def generate_batch(self, prompts: list) -> list:
+        generation_args = {
+            "model_args": self.model.model_args,
+            "cache_args": self.model.cache_args,
+            "stop_sequences": self.model.stop_sequences,
+        }
+        keys = [self.cache.key(self.model_id, generation_args, prompt) for prompt in prompts]
+        outputs = self.cache.get_many(keys)
+        missing = {}
+        for key, prompt in zip(keys, prompts):
+            if key not in outputs:
+                missing[key] = prompt
+        if missing:
+            generated = self.model.generate_batch(list(missing.values()))
+            new_outputs = dict(zip(missing.keys(), generated))
+            self.cache.put_many(new_outputs)
+            outputs.update(new_outputs)
+        return [outputs[key] for key in keys]
+
+
 # =====================
 # Model Loader Factory
 # =====================
@@ -293,6 +595,30 @@ class ModelLoaderFactory:
 # Utility Function
 # =====================
 
+def make_batches(model, prompts, batch_size=None, max_batch_tokens=None):
+    """Splits prompts into consecutive groups of indices.
+
+    A group holds at most `batch_size` prompts (the model's default_batch_size if None) and, if `max_batch_tokens` is given,
+    its padded size (number of prompts x longest prompt in tokens) stays within the budget.
+    A single prompt that exceeds the budget on its own still forms a group.
+    """
+    batch_size = batch_size or model.default_batch_size
+    batches = []
+    current = []
+    longest = 0
+    for i, prompt in enumerate(prompts):
+        num_tokens = model.count_tokens(prompt) if max_batch_tokens else 0
+        padded_size = (len(current) + 1) * max(longest, num_tokens)
+        if current and (len(current) >= batch_size or (max_batch_tokens and padded_size > max_batch_tokens)):
+            batches.append(current)
+            current = []
+            longest = 0
+        current.append(i)
+        longest = max(longest, num_tokens)
+    if current:
+        batches.append(current)
+    return batches
+
 def load_model(model_path, openai_api_key, aws_access_key_id, aws_secret_access_key, hf_token, model_args, quantize):
     model_loader = ModelLoaderFactory.create(
         model_path, 
@@ -1,16 +1,184 @@
 import os
+import glob
+import gzip
 import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
 from collections import defaultdict
 
 
+# 評価器がアイテムごとに記録する集計用の統計量 (全体スコアの再計算に使う)
+ITEM_STATS_KEYS = ['num_correct', 'num_samples', 'bleu_stats']
+
+
+# 正規化形式: 実行情報は1回、プロンプト・参照はアイテムごとに1回だけ書き、サンプルは別の行にする
+NORMALIZED_SUFFIXES = ('.norm.jsonl', '.norm.jsonl.gz', '.norm.jsonl.zst')
+
+# データベース形式: アイテム・サンプル・スコアを SQLite のテーブルに保存する (複数プロセスから同時に書き込める)
+DATABASE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+# =====================
+# Storage Formats
+# =====================
+
+def result_codec(result_path):
+    """Returns the compression of a result file from its extension ('gzip', 'zstd' or None)."""
+    if result_path.endswith('.gz'):
+        return 'gzip'
+    if result_path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def is_normalized(result_path):
+    return result_path.endswith(NORMALIZED_SUFFIXES)
+
+
+def load_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd-compressed result files (.zst) require the 'zstandard' package: pip install zstandard") from e
+    return zstandard
+
+
+def compress_block(codec, data):
+    """Compresses one commit into a self-contained gzip member / zstd frame."""
+    if codec == 'gzip':
+        return gzip.compress(data)
+    if codec == 'zstd':
+        return load_zstandard().ZstdCompressor().compress(data)
+    return data
+
+
+def iter_decompressed(f, codec):
+    """
+    Yields (data, end) for every complete gzip member / zstd frame of a compressed file,
+    where `end` is the file offset right after it. Stops at a member cut off by a crash.
+    """
+    if codec == 'gzip':
+        new_decompressor = lambda: zlib.decompressobj(wbits=31)
+        errors = (zlib.error,)
+    else:
+        zstandard = load_zstandard()
+        new_decompressor = lambda: zstandard.ZstdDecompressor().decompressobj()
+        errors = (zstandard.ZstdError,)
+
+    decompressor = new_decompressor()
+    chunks = []
+    offset = 0
+    data = f.read(READ_BLOCK_SIZE)
+    while data:
+        try:
+            chunks.append(decompressor.decompress(data))
+        except errors:
+            return
+        if decompressor.eof:
+            unused = decompressor.unused_data
+            offset += len(data) - len(unused)
+            yield b''.join(chunks), offset
+            decompressor = new_decompressor()
+            chunks = []
+            data = unused or f.read(READ_BLOCK_SIZE)
+        else:
+            offset += len(data)
+            data = f.read(READ_BLOCK_SIZE)
+
+
+def iter_lines(result_path):
+    """Streams the lines of a result file, decompressing .gz/.zst files."""
+    codec = result_codec(result_path)
+    with open(result_path, 'rb') as f:
+        if codec is None:
+            for line in f:
+                yield line.decode('utf-8')
+            return
+        for data, _ in iter_decompressed(f, codec):
+            for line in data.decode('utf-8').splitlines(keepends=True):
+                yield line
+
+
+def iter_records(lines):
+    """Parses JSON lines; a last line cut off by a crash is ignored."""
+    previous = None
+    for line in lines:
+        if previous is not None:
+            yield json.loads(previous)
+        previous = line
+    if previous is not None:
+        try:
+            yield json.loads(previous)
+        except ValueError:
+            pass
+
+
+def expand_normalized(records):
+    """Reconstructs the row view (one row per sample) from the records of the normalized format."""
+    run = {}
+    item = None
+    for record in records:
+        record_type = record.pop('type', None)
+        if record_type == 'run':
+            run = record
+        elif record_type == 'item':
+            item = record
+        elif record_type == 'sample' and item is not None and record.get('id') == item.get('id'):
+            row = dict(run)
+            if 'id' in item:
+                row['id'] = item['id']
+            row['model_input'] = item.get('model_input', '')
+            row['model_output'] = record.get('model_output')
+            row['formatted_output'] = record.get('formatted_output')
+            row['format_checked'] = record.get('format_checked', '')
+            row['output_format'] = item.get('output_format', '')
+            row['reference'] = item.get('reference', '')
+            row['item_score'] = item.get('item_score', '')
+            for key in ['item_scores'] + ITEM_STATS_KEYS:
+                if key in item:
+                    row[key] = item[key]
+            row['total_score'] = -1
+            yield row
+
+
+def iter_results(result_path):
+    """Streams the rows of a result file (one per sample) in any of the storage formats."""
+    if is_database(result_path):
+        if not os.path.exists(result_path):
+            raise FileNotFoundError(result_path)
+        with SQLiteResultStore(result_path) as store:
+            yield from store.iter_rows()
+        return
+    records = iter_records(iter_lines(result_path))
+    if is_normalized(result_path):
+        records = expand_normalized(records)
+    yield from records
+
+
 def load_existing_results(result_path):
-    """Load existing results from the file."""
+    """Load existing results from the file (a last line cut off by a crash is ignored).
+
+    Plain JSONL, the normalized format (.norm.jsonl), their .gz/.zst compressed variants and
+    result databases (.sqlite/.db) are read as the same rows. If the run has a summary file, its total score is set on the rows.
+    """
     try:
-        with open(result_path, 'r', encoding='utf-8') as f:
-            return [json.loads(line) for line in f]
+        results = list(iter_results(result_path))
     except FileNotFoundError:
         return []
 
+    summary = load_summary(result_path)
+    if summary is not None:
+        for result in results:
+            result['total_score'] = summary['total_score']
+            if 'total_scores' in summary:
+                result['total_scores'] = summary['total_scores']
+    return results
+
 
 def group_and_aggregate_results(results):
     grouped_results = defaultdict(lambda: defaultdict(list))
@@ -25,6 +193,14 @@ def group_and_aggregate_results(results):
     return [dict(result) for result in grouped_results.values()]
 
 
+def metric_view(data, metric_path):
+    """Returns the item as seen by one metric (its own score as item_score)."""
+    item_scores = data.get('item_scores')
+    if isinstance(item_scores, dict) and metric_path in item_scores:
+        return dict(data, item_score=item_scores[metric_path])
+    return data
+
+
 def find_id_value(data):
     for key in data.keys():
         if 'id' in key:
@@ -32,40 +208,818 @@ def find_id_value(data):
     return None
 
 
-def find_unprocessed_data(dataset, existing_results):
-    """Find data in the dataset that has not been processed yet."""
-    processed_ids = {find_id_value(result) for result in existing_results}
-    return [data for data in dataset if find_id_value(data) not in processed_ids]
-
-
-def save_results(result_path, dataset, record, total_score=-1):
-    """Save the evaluation results to a file."""
-    mode = 'a' if total_score == -1 else 'w'
-    
-    directory = os.path.dirname(result_path)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    with open(result_path, mode, encoding='utf-8') as f:
-        for data in dataset:
-            filtered_data = record.copy()
-            for k, v in data.items():
-                if 'id' in k:
-                    filtered_data['id'] = v
-            filtered_data['model_input'] = data.get('model_input', '')
-            model_outputs = data.get('model_output', [])
-            formatted_outputs = data.get('formatted_output', [])
-            format_checked = data.get('format_checked', [])
-            
-            for i, (model_output, formatted_output, format_check) in enumerate(zip(model_outputs, formatted_outputs, format_checked)):
-                filtered_data['model_output'] = model_output
-                filtered_data['formatted_output'] = formatted_output
-
-                filtered_data['format_checked'] = format_check if format_checked else ''
-
-                filtered_data['output_format'] = data.get('output_format', '')
-                filtered_data['reference'] = data.get('reference', '')
-                filtered_data['item_score'] = data.get('item_score', '')
-                filtered_data['total_score'] = total_score
-
-                f.write(json.dumps(filtered_data, ensure_ascii=False) + '\n')
+def find_id_key(data):
+    """Returns the first key that holds the id of a dataset item (the key find_id_value reads)."""
+    for key in data.keys():
+        if 'id' in key:
+            return key
+    return None
+
+
+def row_id(data):
+    """Returns the id written to the result rows of an item (the last key containing 'id', as in format_rows)."""
+    id_value = None
+    for k, v in data.items():
+        if 'id' in k:
+            id_value = v
+    return id_value
+
+
+def find_unprocessed_data(dataset, existing_results=None, processed_ids=None):
+    """Find data in the dataset that has not been processed yet.
+
+    The processed ids can be given directly (e.g. from the index), instead of the existing results.
+    """
+    if processed_ids is None:
+        processed_ids = {find_id_value(result) for result in existing_results}
+    # id のキーはデータセットの先頭のアイテムから1回だけ求める
+    id_key = find_id_key(dataset[0]) if dataset else None
+    if id_key is None:
+        return [data for data in dataset if find_id_value(data) not in processed_ids]
+    return [data for data in dataset
+            if (data[id_key] if id_key in data else find_id_value(data)) not in processed_ids]
+
+
+def summary_path(result_path):
+    """Returns the summary file of `result_path` (total score and run metadata)."""
+    return result_path + '.summary.json'
+
+
+def load_summary(result_path):
+    try:
+        with open(summary_path(result_path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_summary(result_path, record, num_items, total_score, total_scores=None):
+    """Atomically writes the total score(s) of the run next to the result file."""
+    summary = dict(record)
+    summary['num_items'] = num_items
+    summary['total_score'] = total_score
+    if total_scores is not None:
+        summary['total_scores'] = total_scores
+    summary['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    path = summary_path(result_path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+def format_rows(data, record, total_score=-1, total_scores=None):
+    """Serializes one item into its result rows (one JSON line per sample)."""
+    filtered_data = record.copy()
+    for k, v in data.items():
+        if 'id' in k:
+            filtered_data['id'] = v
+    filtered_data['model_input'] = data.get('model_input', '')
+    model_outputs = data.get('model_output', [])
+    formatted_outputs = data.get('formatted_output', [])
+    format_checked = data.get('format_checked', [])
+
+    lines = []
+    for i, (model_output, formatted_output) in enumerate(zip(model_outputs, formatted_outputs)):
+        filtered_data['model_output'] = model_output
+        filtered_data['formatted_output'] = formatted_output
+
+        filtered_data['format_checked'] = format_checked[i] if format_checked else ''
+
+        filtered_data['output_format'] = data.get('output_format', '')
+        filtered_data['reference'] = data.get('reference', '')
+        filtered_data['item_score'] = data.get('item_score', '')
+        if len(data.get('item_scores') or {}) > 1:
+            filtered_data['item_scores'] = data['item_scores']
+        for key in ITEM_STATS_KEYS:
+            if key in data:
+                filtered_data[key] = data[key]
+        filtered_data['total_score'] = total_score
+        if total_scores is not None:
+            filtered_data['total_scores'] = total_scores
+
+        lines.append(json.dumps(filtered_data, ensure_ascii=False) + '\n')
+    return lines
+
+
+def format_normalized_rows(data):
+    """Serializes one item into the normalized format: one item record followed by one record per sample."""
+    item = {'type': 'item'}
+    for k, v in data.items():
+        if 'id' in k:
+            item['id'] = v
+    item['model_input'] = data.get('model_input', '')
+    item['output_format'] = data.get('output_format', '')
+    item['reference'] = data.get('reference', '')
+    item['item_score'] = data.get('item_score', '')
+    if len(data.get('item_scores') or {}) > 1:
+        item['item_scores'] = data['item_scores']
+    for key in ITEM_STATS_KEYS:
+        if key in data:
+            item[key] = data[key]
+
+    model_outputs = data.get('model_output', [])
+    formatted_outputs = data.get('formatted_output', [])
+    format_checked = data.get('format_checked', [])
+    lines = [json.dumps(item, ensure_ascii=False) + '\n']
+    for i, (model_output, formatted_output) in enumerate(zip(model_outputs, formatted_outputs)):
+        sample = {'type': 'sample', 'id': item.get('id'), 'model_output': model_output, 'formatted_output': formatted_output}
+        sample['format_checked'] = format_checked[i] if format_checked else ''
+        lines.append(json.dumps(sample, ensure_ascii=False) + '\n')
+    return lines
+
+
+def save_results(result_path, dataset, record, total_score=-1, total_scores=None):
+    """Save the evaluation results to a file (`total_scores` holds the total of every metric when there are several).
+
+    A result database keeps the total score only in the summary file; the items are inserted (or replaced) by id.
+    """
+    if is_database(result_path):
+        with SQLiteResultWriter(result_path, record, commit_interval=0) as writer:
+            writer.write(dataset)
+        return
+    if total_score != -1 and os.path.exists(result_path):
+        os.remove(result_path)
+    with ResultWriter(result_path, record, commit_interval=0, total_score=total_score, total_scores=total_scores) as writer:
+        writer.write(dataset)
+
+
+def truncate_partial_line(result_path, block_size=65536):
+    """Removes a last line left incomplete by a crash, so that new rows start on a fresh line."""
+    try:
+        f = open(result_path, 'rb+')
+    except FileNotFoundError:
+        return
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            block = f.read(position - start)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position != end:
+            f.truncate(position)
+
+
+def index_path(result_path):
+    """Returns the index of `result_path`: the ids of the committed items, followed by commit markers."""
+    return result_path + '.idx'
+
+
+def read_index(result_path):
+    """
+    Returns (ids, end) from the index: the ids of the committed items and the size of the result
+    file they cover (None without an index). Entries after the last commit marker are ignored.
+    """
+    ids = []
+    pending = []
+    end = None
+    try:
+        lines = list(iter_lines(index_path(result_path)))
+    except FileNotFoundError:
+        return [], None
+    for record in iter_records(lines):
+        if 'end' in record:
+            ids.extend(pending)
+            pending = []
+            end = record['end']
+        else:
+            pending.append(record['id'])
+    return ids, end
+
+
+def index_end(result_path, block_size=4096):
+    """Reads only the last commit marker of the index; returns the covered file size (None if missing)."""
+    try:
+        f = open(index_path(result_path), 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - block_size))
+        for line in reversed(f.read().splitlines()):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'end' in record:
+                return record['end']
+    return None
+
+
+def scan_index_entries(result_path):
+    """Scans the result file and returns (ids of its items, size of the complete part of the file)."""
+    codec = result_codec(result_path)
+    ids = []
+
+    def add(id_value):
+        if id_value is not None and (not ids or ids[-1] != id_value):
+            ids.append(id_value)
+
+    try:
+        f = open(result_path, 'rb')
+    except FileNotFoundError:
+        return [], 0
+    with f:
+        if codec is None:
+            offset = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                record = json.loads(line)
+                if record.get('type') != 'run':
+                    add(record.get('id'))
+                offset += len(line)
+            return ids, offset
+        end = 0
+        for data, end in iter_decompressed(f, codec):
+            for line in data.splitlines():
+                record = json.loads(line)
+                if record.get('type') != 'run':
+                    add(record.get('id'))
+        return ids, end
+
+
+def rebuild_index(result_path):
+    """Rebuilds the index from the result file (e.g. after a crash or for files written without one)."""
+    ids, end = scan_index_entries(result_path)
+    path = index_path(result_path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        for id_value in ids:
+            f.write(json.dumps({'id': id_value}, ensure_ascii=False) + '\n')
+        f.write(json.dumps({'end': end}) + '\n')
+    os.replace(temp_path, path)
+
+
+def load_processed_ids(result_path):
+    """Returns the ids of the processed items from the index, rebuilding it if it does not cover the result file."""
+    if is_database(result_path):
+        if not os.path.exists(result_path):
+            return set()
+        with SQLiteResultStore(result_path) as store:
+            return store.processed_ids()
+    try:
+        size = os.path.getsize(result_path)
+    except FileNotFoundError:
+        return set()
+    ids, end = read_index(result_path)
+    if end != size:
+        repair_tail(result_path)
+        rebuild_index(result_path)
+        ids, end = read_index(result_path)
+    return {id_value for id_value in ids if id_value}
+
+
+def truncate_torn_commit(result_path):
+    """
+    Cuts an uncompressed file back to the end of its last indexed commit if it ends with a partial line.
+
+    A commit is written in one call, so a partial last line means the whole commit was cut off;
+    removing only that line would leave the complete rows before it (e.g. some samples of an item).
+    """
+    end = index_end(result_path)
+    try:
+        f = open(result_path, 'rb+')
+    except FileNotFoundError:
+        return
+    with f:
+        size = f.seek(0, os.SEEK_END)
+        if end is None or not 0 <= end < size:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            # 最後のコミットは書き終わっている (索引の追記前に中断された)
+            return
+        if end > 0:
+            f.seek(end - 1)
+            if f.read(1) != b'\n':
+                # 索引が別のファイルのものである
+                return
+        f.truncate(end)
+
+
+def repair_tail(result_path):
+    """Cuts off a last line (or compressed member) left incomplete by a crash, so new rows are appended cleanly."""
+    codec = result_codec(result_path)
+    if codec is None:
+        truncate_torn_commit(result_path)
+        truncate_partial_line(result_path)
+        return
+    try:
+        f = open(result_path, 'rb+')
+    except FileNotFoundError:
+        return
+    with f:
+        end = 0
+        for _, end in iter_decompressed(f, codec):
+            pass
+        if f.seek(0, os.SEEK_END) != end:
+            f.truncate(end)
+
+
+class ResultWriter:
+    """
+    Appends result rows to `result_path` through one open file, committing them in groups.
+
+    Rows are buffered in memory and committed (written and flushed to the OS) when the buffer
+    exceeds `buffer_size` bytes or `commit_interval` seconds have passed since the last commit;
+    a background thread commits idle buffers so finished items never wait longer than that.
+    Every `fsync_interval` seconds (and on close) a commit is also fsync-ed to disk.
+    A crash therefore loses at most the items finished since the last commit, and they are
+    simply processed again on resume.
+
+    The storage format follows the extension (see NORMALIZED_SUFFIXES); with .gz/.zst every
+    commit is written as a self-contained compressed member.
+    """
+    def __init__(self, result_path, record, commit_interval=1.0, fsync_interval=0, buffer_size=1024 * 1024,
+                 total_score=-1, total_scores=None):
+        directory = os.path.dirname(result_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.result_path = result_path
+        self.record = record
+        self.commit_interval = commit_interval
+        self.fsync_interval = fsync_interval
+        self.buffer_size = buffer_size
+        self.total_score = total_score
+        self.total_scores = total_scores
+        self.codec = result_codec(result_path)
+        self.normalized = is_normalized(result_path)
+        size = os.path.getsize(result_path) if os.path.exists(result_path) else 0
+        # 索引がファイル全体を覆っていない場合 (旧形式のファイルや異常終了後) のみ、
+        # 途中で切れた末尾を取り除いて索引を作り直す (圧縮ファイルでも毎回全体を展開しない)
+        if index_end(result_path) != size:
+            repair_tail(result_path)
+            rebuild_index(result_path)
+        self.file = open(result_path, 'ab')
+        self.index_file = open(index_path(result_path), 'a', encoding='utf-8')
+        self.offset = self.file.seek(0, os.SEEK_END)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.buffered_ids = []
+        if self.normalized and record is not None:
+            self.buffer_lines([json.dumps(dict(record, type='run'), ensure_ascii=False) + '\n'])
+        self.start()
+
+    def start(self):
+        """Starts the background thread that commits idle buffers."""
+        self.last_commit = time.monotonic()
+        self.last_fsync = self.last_commit
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.commit_thread = None
+        if self.commit_interval and self.commit_interval > 0:
+            self.commit_thread = threading.Thread(target=self.commit_loop, name="result-writer", daemon=True)
+            self.commit_thread.start()
+
+    def write(self, dataset):
+        """Buffers the rows of finished items and commits them if a threshold is reached."""
+        with self.lock:
+            for data in dataset:
+                if self.normalized:
+                    self.buffer_lines(format_normalized_rows(data), row_id(data))
+                else:
+                    self.buffer_lines(format_rows(data, self.record, self.total_score, self.total_scores), row_id(data))
+            self.commit_if_due()
+
+    def write_lines(self, lines):
+        """Buffers already serialized lines of the same format (used to merge worker results)."""
+        with self.lock:
+            for line in lines:
+                record = json.loads(line)
+                if record.get('type') == 'run':
+                    self.buffer_lines([line])
+                else:
+                    self.buffer_lines([line], record.get('id'))
+            self.commit_if_due()
+
+    def buffer_lines(self, lines, id_value=None):
+        """Buffers serialized lines; the id of the item is added to the index on commit."""
+        start = self.buffered_bytes
+        for line in lines:
+            encoded = line.encode('utf-8')
+            self.buffer.append(encoded)
+            self.buffered_bytes += len(encoded)
+        if id_value is None or start == self.buffered_bytes:
+            return
+        if not self.buffered_ids or self.buffered_ids[-1] != id_value:
+            self.buffered_ids.append(id_value)
+
+    def commit_if_due(self):
+        if (not self.commit_interval or self.buffered_bytes >= self.buffer_size
+                or time.monotonic() - self.last_commit >= self.commit_interval):
+            self.commit()
+
+    def commit(self, sync=False):
+        # ロックを保持した状態で呼び出す
+        if self.buffer:
+            # 行の途中で中断されにくいよう、まとめて1回で書き込む
+            block = compress_block(self.codec, b''.join(self.buffer))
+            self.file.write(block)
+            self.file.flush()
+            # 結果を書き込んだ後に索引を追記する (索引が結果より先に進むことはない)
+            index_lines = [json.dumps({'id': id_value}, ensure_ascii=False) + '\n' for id_value in self.buffered_ids]
+            self.offset += len(block)
+            index_lines.append(json.dumps({'end': self.offset}) + '\n')
+            self.index_file.write(''.join(index_lines))
+            self.index_file.flush()
+            self.buffer = []
+            self.buffered_bytes = 0
+            self.buffered_ids = []
+        now = time.monotonic()
+        self.last_commit = now
+        if sync or (self.fsync_interval and now - self.last_fsync >= self.fsync_interval):
+            os.fsync(self.file.fileno())
+            os.fsync(self.index_file.fileno())
+            self.last_fsync = now
+
+    def commit_loop(self):
+        while not self.closed.wait(self.commit_interval):
+            with self.lock:
+                if self.buffer and time.monotonic() - self.last_commit >= self.commit_interval:
+                    self.commit()
+
+    def checkpoint(self):
+        """Commits all buffered rows and fsyncs the file."""
+        with self.lock:
+            self.commit(sync=True)
+
+    def close(self):
+        self.closed.set()
+        if self.commit_thread is not None:
+            self.commit_thread.join()
+        with self.lock:
+            if not self.file.closed:
+                self.commit(sync=True)
+                self.file.close()
+                self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# =====================
+# SQLite Backend
+# =====================
+
+# 処理済みとして扱うアイテム (group_and_aggregate_results と同じく id が偽の値のアイテムは除く)
+VALID_ITEMS = "i.id IS NOT NULL AND i.id NOT IN ('', 0)"
+
+
+def is_database(result_path):
+    return result_path.endswith(DATABASE_SUFFIXES)
+
+
+def format_database_item(data):
+    """Serializes one item into the columns of the result database: (item, samples, scores)."""
+    item_score = data.get('item_score', '')
+    item_scores = data.get('item_scores') or {}
+    item = {
+        'id': row_id(data),
+        'model_input': json.dumps(data.get('model_input', ''), ensure_ascii=False),
+        'output_format': json.dumps(data.get('output_format', ''), ensure_ascii=False),
+        'reference': json.dumps(data.get('reference', ''), ensure_ascii=False),
+        'item_score': None if item_score == '' else item_score,
+        'item_scores': json.dumps(item_scores, ensure_ascii=False) if len(item_scores) > 1 else None,
+        'num_samples': data.get('num_samples'),
+        'num_correct': data.get('num_correct'),
+        'bleu_stats': json.dumps(data['bleu_stats']) if 'bleu_stats' in data else None,
+    }
+    model_outputs = data.get('model_output', [])
+    formatted_outputs = data.get('formatted_output', [])
+    format_checked = data.get('format_checked', [])
+    samples = []
+    for i, (model_output, formatted_output) in enumerate(zip(model_outputs, formatted_outputs)):
+        samples.append((
+            i,
+            json.dumps(model_output, ensure_ascii=False),
+            json.dumps(formatted_output, ensure_ascii=False),
+            json.dumps(format_checked[i] if format_checked else '', ensure_ascii=False),
+        ))
+    scores = [(metric_path, None if score == '' else score) for metric_path, score in item_scores.items()]
+    return item, samples, scores
+
+
+class SQLiteResultStore:
+    """
+    A result database (.sqlite/.db) holding runs, items, samples and per-metric scores in indexed tables.
+
+    The database is opened in WAL mode and every write is one short transaction, so several
+    processes can insert items into the same database at the same time (e.g. the workers of a
+    run, or several runs resuming the same result_path). Resume and aggregation are SQL queries.
+    WAL needs shared memory, so all writers must run on the same host (not over NFS).
+    """
+    def __init__(self, result_path):
+        directory = os.path.dirname(result_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.result_path = result_path
+        self.run_keys = {}
+        # トランザクションは明示的に開始する (BEGIN IMMEDIATE で書き込みロックを先に取る)
+        self.connection = sqlite3.connect(result_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS runs (run_key INTEGER PRIMARY KEY, record TEXT NOT NULL UNIQUE)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "item_key INTEGER PRIMARY KEY, id UNIQUE, run_key INTEGER, model_input TEXT, output_format TEXT, "
+            "reference TEXT, item_score REAL, item_scores TEXT, num_samples INTEGER, num_correct INTEGER, bleu_stats TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS samples ("
+            "item_key INTEGER NOT NULL, sample_index INTEGER NOT NULL, model_output TEXT, formatted_output TEXT, "
+            "format_checked TEXT, PRIMARY KEY (item_key, sample_index)) WITHOUT ROWID"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "metric_path TEXT NOT NULL, item_key INTEGER NOT NULL, score REAL, "
+            "PRIMARY KEY (metric_path, item_key)) WITHOUT ROWID"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS items_counts ON items (num_samples, num_correct)")
+
+    @property
+    def closed(self):
+        return self.connection is None
+
+    def run_key(self, record):
+        if record is None:
+            return None
+        serialized = json.dumps(record, ensure_ascii=False)
+        if serialized not in self.run_keys:
+            self.connection.execute("INSERT OR IGNORE INTO runs (record) VALUES (?)", (serialized,))
+            self.run_keys[serialized] = self.connection.execute(
+                "SELECT run_key FROM runs WHERE record = ?", (serialized,)
+            ).fetchone()[0]
+        return self.run_keys[serialized]
+
+    def insert(self, items, record=None):
+        """Inserts items formatted by format_database_item in one transaction; an item with the same id is replaced."""
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            run_key = self.run_key(record)
+            for item, samples, scores in items:
+                # 結果ファイルと同じく、サンプルのないアイテムは書き込まない (再開時に再処理される)
+                if not samples:
+                    continue
+                if item['id'] is not None:
+                    existing = self.connection.execute("SELECT item_key FROM items WHERE id = ?", (item['id'],)).fetchone()
+                    if existing:
+                        self.delete_item(existing[0])
+                cursor = self.connection.execute(
+                    "INSERT INTO items (id, run_key, model_input, output_format, reference, item_score, item_scores, "
+                    "num_samples, num_correct, bleu_stats) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (item['id'], run_key, item['model_input'], item['output_format'], item['reference'], item['item_score'],
+                     item['item_scores'], item['num_samples'], item['num_correct'], item['bleu_stats']),
+                )
+                item_key = cursor.lastrowid
+                self.connection.executemany(
+                    "INSERT INTO samples (item_key, sample_index, model_output, formatted_output, format_checked) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(item_key,) + sample for sample in samples],
+                )
+                self.connection.executemany(
+                    "INSERT INTO scores (metric_path, item_key, score) VALUES (?, ?, ?)",
+                    [(metric_path, item_key, score) for metric_path, score in scores],
+                )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def delete_item(self, item_key):
+        self.connection.execute("DELETE FROM samples WHERE item_key = ?", (item_key,))
+        self.connection.execute("DELETE FROM scores WHERE item_key = ?", (item_key,))
+        self.connection.execute("DELETE FROM items WHERE item_key = ?", (item_key,))
+
+    def iter_rows(self):
+        """Yields one row per sample, the same rows as a JSONL result file."""
+        runs = {run_key: json.loads(record) for run_key, record in self.connection.execute("SELECT run_key, record FROM runs")}
+        cursor = self.connection.execute(
+            "SELECT i.run_key, i.id, i.model_input, i.output_format, i.reference, i.item_score, i.item_scores, "
+            "i.num_samples, i.num_correct, i.bleu_stats, s.model_output, s.formatted_output, s.format_checked "
+            "FROM items i JOIN samples s ON s.item_key = i.item_key ORDER BY i.item_key, s.sample_index"
+        )
+        for (run_key, id_value, model_input, output_format, reference, item_score, item_scores,
+             num_samples, num_correct, bleu_stats, model_output, formatted_output, format_checked) in cursor:
+            row = dict(runs.get(run_key, {}))
+            if id_value is not None:
+                row['id'] = id_value
+            row['model_input'] = json.loads(model_input)
+            row['model_output'] = json.loads(model_output)
+            row['formatted_output'] = json.loads(formatted_output)
+            row['format_checked'] = json.loads(format_checked)
+            row['output_format'] = json.loads(output_format)
+            row['reference'] = json.loads(reference)
+            row['item_score'] = '' if item_score is None else item_score
+            if item_scores is not None:
+                row['item_scores'] = json.loads(item_scores)
+            if num_samples is not None:
+                row['num_correct'] = num_correct
+                row['num_samples'] = num_samples
+            if bleu_stats is not None:
+                row['bleu_stats'] = json.loads(bleu_stats)
+            row['total_score'] = -1
+            yield row
+
+    def processed_ids(self):
+        return {id_value for (id_value,) in self.connection.execute("SELECT id FROM items") if id_value}
+
+    def score_totals(self, metric_path):
+        """Returns {"sum", "count"} of the scores of one metric (item_score for items without per-metric scores)."""
+        total, count = self.connection.execute(
+            "SELECT COALESCE(SUM(score), 0.0), COUNT(score) FROM ("
+            "SELECT CASE WHEN s.item_key IS NULL THEN i.item_score ELSE s.score END AS score "
+            "FROM items i LEFT JOIN scores s ON s.item_key = i.item_key AND s.metric_path = ? "
+            f"WHERE {VALID_ITEMS})",
+            (metric_path,),
+        ).fetchone()
+        return {"sum": float(total), "count": count}
+
+    def sample_count_histogram(self, metric_path):
+        """Returns {"num_samples/num_correct": number of items} (the pass@k state of code_eval)."""
+        counts = defaultdict(int)
+        for num_samples, num_correct, frequency in self.connection.execute(
+            "SELECT i.num_samples, i.num_correct, COUNT(*) FROM items i "
+            f"WHERE {VALID_ITEMS} AND i.num_samples IS NOT NULL GROUP BY i.num_samples, i.num_correct"
+        ):
+            counts[f"{num_samples}/{num_correct}"] += frequency
+        # カウントを持たないアイテムは item_score (= 正解率) と候補数から復元する
+        for score, num_samples in self.connection.execute(
+            "SELECT CASE WHEN s.item_key IS NULL THEN i.item_score ELSE s.score END, "
+            "(SELECT COUNT(*) FROM samples WHERE samples.item_key = i.item_key) "
+            "FROM items i LEFT JOIN scores s ON s.item_key = i.item_key AND s.metric_path = ? "
+            f"WHERE {VALID_ITEMS} AND i.num_samples IS NULL",
+            (metric_path,),
+        ):
+            if score is not None:
+                counts[f"{num_samples}/{round(score * num_samples)}"] += 1
+        return dict(counts)
+
+    def bleu_stats_sums(self):
+        """Returns the summed BLEU statistics of all items, or None if some item has none recorded."""
+        num_missing, max_order = self.connection.execute(
+            "SELECT COUNT(*) - COUNT(i.bleu_stats), MAX(json_array_length(i.bleu_stats, '$.matches')) "
+            f"FROM items i WHERE {VALID_ITEMS}"
+        ).fetchone()
+        if num_missing or max_order is None:
+            return None
+        columns = [f"SUM(json_extract(i.bleu_stats, '$.{key}[{order}]'))"
+                   for key in ('matches', 'possible') for order in range(max_order)]
+        columns += ["SUM(json_extract(i.bleu_stats, '$.translation_length'))",
+                    "SUM(json_extract(i.bleu_stats, '$.reference_length'))"]
+        sums = self.connection.execute(f"SELECT {', '.join(columns)} FROM items i WHERE {VALID_ITEMS}").fetchone()
+        return {
+            "matches": list(sums[:max_order]), "possible": list(sums[max_order:2 * max_order]),
+            "translation_length": sums[-2], "reference_length": sums[-1],
+        }
+
+    def checkpoint(self):
+        """Copies the WAL into the database file; the WAL is synced to disk first."""
+        self.connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SQLiteResultWriter(ResultWriter):
+    """
+    ResultWriter for result databases: every commit inserts the buffered items in one transaction.
+
+    Several writers (processes) can commit to the same database at the same time. Every
+    `fsync_interval` seconds (and on close) the WAL is checkpointed, which syncs it to disk.
+    """
+    def __init__(self, result_path, record, commit_interval=1.0, fsync_interval=0, buffer_size=1024 * 1024):
+        self.result_path = result_path
+        self.record = record
+        self.commit_interval = commit_interval
+        self.fsync_interval = fsync_interval
+        self.buffer_size = buffer_size
+        self.store = SQLiteResultStore(result_path)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.start()
+
+    def write(self, dataset):
+        """Buffers finished items and commits them if a threshold is reached."""
+        with self.lock:
+            for data in dataset:
+                item, samples, scores = format_database_item(data)
+                self.buffer.append((item, samples, scores))
+                self.buffered_bytes += len(item['model_input']) + len(item['reference'])
+                self.buffered_bytes += sum(len(sample[1]) + len(sample[2]) for sample in samples)
+            self.commit_if_due()
+
+    def commit(self, sync=False):
+        # ロックを保持した状態で呼び出す
+        if self.buffer:
+            self.store.insert(self.buffer, self.record)
+            self.buffer = []
+            self.buffered_bytes = 0
+        now = time.monotonic()
+        self.last_commit = now
+        if sync or (self.fsync_interval and now - self.last_fsync >= self.fsync_interval):
+            self.store.checkpoint()
+            self.last_fsync = now
+
+    def close(self):
+        self.closed.set()
+        if self.commit_thread is not None:
+            self.commit_thread.join()
+        with self.lock:
+            if not self.store.closed:
+                self.commit(sync=True)
+                self.store.close()
+
+
+def load_result_writer(result_path, record, commit_interval=1.0, fsync_interval=0):
+    """Returns the writer of the backend selected by the extension of `result_path`."""
+    if is_database(result_path):
+        return SQLiteResultWriter(result_path, record, commit_interval, fsync_interval)
+    return ResultWriter(result_path, record, commit_interval, fsync_interval)
+
+
+def shard_result_path(result_path, index):
+    """Returns the per-worker result file for shard `index` (e.g. result.jsonl -> result.shard0.jsonl)."""
+    directory, filename = os.path.split(result_path)
+    name, dot, extension = filename.partition('.')
+    return os.path.join(directory, f"{name}.shard{index}{dot}{extension}")
+
+
+def merge_shard_results(result_path):
+    """Appends the rows of all per-worker result files to `result_path`, removes them and returns the rows."""
+    if is_database(result_path):
+        # ワーカーはデータベースに直接書き込むため、シャードはない
+        return []
+    directory, filename = os.path.split(result_path)
+    name, dot, extension = filename.partition('.')
+    pattern = os.path.join(glob.escape(directory), f"{glob.escape(name)}.shard[0-9]*{glob.escape(dot + extension)}")
+    # glob の * は別の拡張子にも一致するため (e.g. res.jsonl に対する res.shard0.norm.jsonl)、番号部分を厳密に確認する
+    shard_name = re.compile(rf"{re.escape(name)}\.shard\d+{re.escape(dot + extension)}")
+    shard_paths = sorted(path for path in glob.glob(pattern) if shard_name.fullmatch(os.path.basename(path)))
+    if not shard_paths:
+        return []
+
+    merged_results = []
+    # シャードはマージ先と同じ形式なので、行をそのまま (必要なら再圧縮して) 追記する
+    with ResultWriter(result_path, None, commit_interval=0) as writer:
+        for shard_path in shard_paths:
+            writer.write_lines(line for line in iter_lines(shard_path) if line.endswith('\n'))
+            merged_results.extend(load_existing_results(shard_path))
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+        if os.path.exists(index_path(shard_path)):
+            os.remove(index_path(shard_path))
+    return merged_results
+
+
+def state_path(result_path):
+    """Returns the file that holds the running-aggregate state of `result_path`."""
+    return result_path + '.state.json'
+
+
+def load_state(result_path, metric_path, key):
+    """Loads the persisted aggregate state of one metric; returns (state, num_items) or (None, 0) if missing or made for another `key`."""
+    try:
+        with open(state_path(result_path), 'r', encoding='utf-8') as f:
+            saved = json.load(f).get(metric_path)
+    except (FileNotFoundError, ValueError, AttributeError):
+        return None, 0
+    if not saved or saved.get('key') != key:
+        return None, 0
+    return saved['state'], saved['num_items']
+
+
+def save_state(result_path, metric_path, key, state, num_items):
+    """Atomically writes the aggregate state of one metric covering the first `num_items` items of `result_path`."""
+    path = state_path(result_path)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            states = json.load(f)
+    except (FileNotFoundError, ValueError):
+        states = {}
+    if not isinstance(states, dict):
+        states = {}
+    states[metric_path] = {'key': key, 'num_items': num_items, 'state': state}
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(states, f, ensure_ascii=False)
+    os.replace(temp_path, path)
@@ -0,0 +1,102 @@
+import copy
+import json
+import threading
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from config_utils import build_parser, parse_args_and_config, fill_default_args, check_required_args, JOB_ARGS
+from main import build_model, run_job, debug_print
+
+
+# =====================
+# Model Server
+# =====================
+
+class EvalServer:
+    """Holds a loaded model and runs evaluation jobs against it one at a time."""
+    def __init__(self, args):
+        self.args = args
+        self.model = build_model(args)
+        self.lock = threading.Lock()
+
+    def job_args(self, job: dict):
+        """Builds the arguments of a job from the server's arguments and the job's fields."""
+        unknown = [key for key in job if key not in JOB_ARGS]
+        if unknown:
+            raise ValueError(f"Unsupported job fields: {unknown}. Supported fields are {JOB_ARGS}.")
+        args = copy.copy(self.args)
+        args.result_path = None
+        for key, value in job.items():
+            setattr(args, key, value)
+        args.num_workers = 1
+        check_required_args(args, ['dataset_path', 'template_path'])
+        fill_default_args(args)
+        return args
+
+    def run(self, job: dict) -> dict:
+        args = self.job_args(job)
+        # ジョブごとにテンプレートをモデルに設定するため、同時には1ジョブのみ実行する
+        with self.lock:
+            debug_print(self.args.debug_mode, "Job:\n", job)
+            total_score = run_job(args, self.model)
+        return {"result_path": args.result_path, "total_score": total_score}
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """HTTP interface: POST /jobs runs a job, GET /health reports the loaded model."""
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {"status": "ok", "model": self.server.eval_server.args.model_path})
+        else:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(job, dict):
+                raise ValueError("The job must be a JSON object.")
+        except (ValueError, UnicodeDecodeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        try:
+            response = self.server.eval_server.run(job)
+        except (ValueError, KeyError, FileNotFoundError) as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+        else:
+            self.send_json(200, response)
+
+
+def main():
+    parser = build_parser()
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host the model server listens on')
+    parser.add_argument('--port', type=int, default=8765, help='Port the model server listens on')
+    args = parse_args_and_config(parser, required_args=['model_path'])
+
+    httpd = ThreadingHTTPServer((args.host, args.port), JobRequestHandler)
+    httpd.eval_server = EvalServer(args)
+    print(f"Model server for {args.model_path} listening on http://{args.host}:{args.port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import queue
+import threading
+
+
+_DONE = object()
+
+
+# =====================
+# Staged Pipeline
+# =====================
+
+class StagePipeline:
+    """
+    Runs a sequence of stages concurrently, each in its own thread, connected by bounded queues.
+
+    Every item fed to `run` passes through the stages in order, so item N can be in a later
+    stage while item N+1 is in an earlier one. Items keep their order. If a stage raises, that stage
+    and the ones before it stop taking new items, the later stages (e.g. writing results) finish
+    the items already queued for them, and then the error is re-raised by `run`.
+    """
+    def __init__(self, stages: list, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.error = None
+        # このインデックス以前のステージは新しい項目を処理しない
+        self.stopped_through = -1
+        self.lock = threading.Lock()
+
+    def fail(self, error, stage_index):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+            self.stopped_through = max(self.stopped_through, stage_index)
+
+    def worker(self, stage_index, stage_fn, input_queue, output_queue):
+        while True:
+            item = input_queue.get()
+            if item is _DONE:
+                if output_queue is not None:
+                    output_queue.put(_DONE)
+                return
+            if stage_index <= self.stopped_through:
+                continue
+            try:
+                result = stage_fn(item)
+            except BaseException as e:
+                self.fail(e, stage_index)
+                continue
+            if output_queue is not None:
+                output_queue.put(result)
+
+    def run(self, items):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+        for i, (name, stage_fn) in enumerate(self.stages):
+            output_queue = queues[i + 1] if i + 1 < len(queues) else None
+            thread = threading.Thread(
+                target=self.worker, args=(i, stage_fn, queues[i], output_queue), name=f"stage-{name}", daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for item in items:
+                if self.error is not None:
+                    break
+                queues[0].put(item)
+        finally:
+            queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
@@ -1,8 +1,12 @@
 import json
 import re
+import string
 import ast
 import textwrap
 
+HUMANEVAL_STOP_SEQUENCES = ["\nclass", "\ndef", "\n#", "\n@", "\nprint", "\nif", "\n```"]
+
+
 class TemplateProcessor:
     def __init__(self, template_path):
         self.template_path = template_path
@@ -28,6 +32,46 @@ class TemplateProcessor:
         except IndexError as e:
             raise IndexError(f"Index error in template formatting: {e}")
     
+    def static_prefix(self):
+        """Returns the literal text at the start of the template, shared by every prompt."""
+        prefix = ""
+        for literal_text, field_name, _, _ in string.Formatter().parse(self.template_string):
+            prefix += literal_text
+            if field_name is not None:
+                break
+        return prefix
+
+    def stop_sequences(self, truncating_only=False):
+        """
+        Returns the strings at which generation can stop early for this template.
+
+        Sequences can be declared with "stop_sequences" in the template file (used as-is by every
+        backend); otherwise they are
+        derived from the format (humaneval stop list, </tag> for xml_<tag>) and the end_marker.
+        Closing markers and tags must stay in the model output because collation looks for them,
+        so `truncating_only` returns only the sequences that collation cuts off anyway.
+        """
+        if "stop_sequences" in self.template_data:
+            return list(self.template_data["stop_sequences"])
+
+        output_format = self.template_data.get('format', 'default')
+        begin_marker = self.template_data.get('begin_marker', None)
+        end_marker = self.template_data.get('end_marker', None)
+
+        truncating = []
+        closing = []
+        if output_format == 'humaneval' and not begin_marker:
+            # マーカーがある場合はマーカー内を抽出した後に適用されるため、生成時には使えない
+            truncating.extend(HUMANEVAL_STOP_SEQUENCES)
+        elif 'xml_' in output_format:
+            closing.append(f"</{output_format.split('_')[1]}>")
+        if begin_marker and end_marker and end_marker != begin_marker:
+            closing.append(end_marker)
+
+        if truncating_only:
+            return truncating
+        return truncating + closing
+
     def process_reference(self, data):
         """Creates a reference using the loaded template and provided data."""
         try:
@@ -205,9 +249,8 @@ class TemplateProcessor:
     def format_humaneval(self, prompt, model_output):
         """Collates the model output for the humaneval format."""
         model_output = model_output.strip('<outpuT>')
-        stop_sequences=["\nclass", "\ndef", "\n#", "\n@", "\nprint", "\nif", "\n```"]
         min_stop_index = len(model_output)
-        for seq in stop_sequences:
+        for seq in HUMANEVAL_STOP_SEQUENCES:
             stop_index = model_output.find(seq)
             if stop_index != -1 and stop_index < min_stop_index:
                 min_stop_index = stop_index
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# scripts/ のモジュールはトップレベルのモジュールとして読み込む (main.py と同じ)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
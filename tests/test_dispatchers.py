@@ -0,0 +1,155 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from dispatchers import AsyncDispatcher
+
+
+# =====================
+# Fake OpenAI-compatible Server
+# =====================
+
+class FakeChatHandler(BaseHTTPRequestHandler):
+    """POST /v1/chat/completions: echoes the prompt; the first attempt of every third prompt gets a 429."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        state = self.server.state
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = body["messages"][0]["content"]
+        with state["lock"]:
+            state["in_flight"] += 1
+            state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            attempt = state["attempts"].get(prompt, 0)
+            state["attempts"][prompt] = attempt + 1
+        time.sleep(0.05)
+        with state["lock"]:
+            state["in_flight"] -= 1
+
+        if attempt == 0 and int(prompt.split()[-1]) % 3 == 0:
+            with state["lock"]:
+                state["rate_limited"] += 1
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                           {"retry-after": str(self.server.retry_after)})
+            return
+        self.send_json(200, {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [
+                {"index": i, "finish_reason": "stop", "message": {"role": "assistant", "content": f"echo: {prompt} #{i}"}}
+                for i in range(body.get("n", 1))
+            ],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        })
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def fake_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeChatHandler)
+    server.daemon_threads = True
+    server.retry_after = 0.2
+    server.state = {"lock": threading.Lock(), "in_flight": 0, "max_in_flight": 0, "attempts": {}, "rate_limited": 0}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def base_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+# =====================
+# AsyncDispatcher
+# =====================
+
+def post_chat(server, prompt):
+    request = urllib.request.Request(
+        base_url(server) + "/chat/completions",
+        data=json.dumps({"model": "fake", "messages": [{"role": "user", "content": prompt}]}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())["choices"][0]["message"]["content"]
+
+
+def retry_after(error):
+    if isinstance(error, urllib.error.HTTPError) and error.code == 429:
+        return float(error.headers.get("retry-after") or 0.0)
+    return None
+
+
+def test_dispatcher_limits_in_flight_retries_429_and_keeps_order(fake_server):
+    dispatcher = AsyncDispatcher(max_in_flight=4, initial_backoff=0.01)
+    prompts = [f"prompt {i}" for i in range(12)]
+
+    async def request(prompt):
+        return await asyncio.to_thread(post_chat, fake_server, prompt)
+
+    try:
+        started = time.monotonic()
+        outputs = dispatcher.run(request, prompts, retry_after_fn=retry_after)
+        elapsed = time.monotonic() - started
+    finally:
+        dispatcher.close()
+
+    state = fake_server.state
+    assert outputs == [f"echo: {prompt} #0" for prompt in prompts]
+    assert state["max_in_flight"] == 4
+    assert state["rate_limited"] == 4
+    assert all(state["attempts"][prompt] == (2 if i % 3 == 0 else 1) for i, prompt in enumerate(prompts))
+    # 429 を受けたリクエストは retry-after の間待ってから再送される
+    assert elapsed >= fake_server.retry_after
+
+
+def test_dispatcher_does_not_retry_other_errors():
+    dispatcher = AsyncDispatcher(max_in_flight=2, initial_backoff=0.01)
+
+    async def request(prompt):
+        raise ValueError(prompt)
+
+    try:
+        with pytest.raises(ValueError):
+            dispatcher.run(request, ["a", "b"], retry_after_fn=retry_after)
+    finally:
+        dispatcher.close()
+
+
+# =====================
+# OpenAIModel
+# =====================
+
+def test_openai_model_against_fake_server(fake_server):
+    pytest.importorskip("openai")
+    from models import OpenAIModel
+
+    model = OpenAIModel("sk-fake", "gpt-fake", {"base_url": base_url(fake_server), "max_in_flight": 4, "n": 2})
+    model.dispatcher.initial_backoff = 0.01
+    prompts = [f"prompt {i}" for i in range(12)]
+    try:
+        outputs = model.generate_batch(prompts)
+    finally:
+        model.dispatcher.close()
+
+    assert outputs == [[f"echo: {prompt} #0", f"echo: {prompt} #1"] for prompt in prompts]
+    assert fake_server.state["max_in_flight"] == 4
+    assert fake_server.state["rate_limited"] == 4
+    assert model.default_batch_size == 16
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from executors import ExecutionPool
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = ExecutionPool(num_workers=2, timeout=1.0, memory_limit_mb=256)
+    yield pool
+    pool.close()
+
+
+def test_pass_and_fail(pool):
+    programs = [
+        "def add(a, b):\n    return a + b\nassert add(1, 2) == 3",
+        "def add(a, b):\n    return a - b\nassert add(1, 2) == 3",
+        "syntax error (",
+        "import math\nassert math.sqrt(4) == 2",
+    ]
+    assert pool.run(programs) == [True, False, False, True]
+    assert pool.run([]) == []
+
+
+def test_timeout(pool):
+    assert pool.run(["while True:\n    pass", "import time\ntime.sleep(10)", "x = 1"]) == [False, False, True]
+
+
+def test_memory_limit(pool):
+    # 256MB の制限を超える確保は失敗し、制限内の確保は成功する
+    assert pool.run(["x = bytearray(1024 ** 3)", "x = bytearray(16 * 1024 ** 2)"]) == [False, True]
+
+
+def test_exit_counts_as_failure(pool):
+    programs = ["exit()", "import sys\nsys.exit(0)", "raise SystemExit(0)", "import os\nos._exit(0)"]
+    assert pool.run(programs) == [False, False, False, False]
+
+
+def test_guard_blocks_harmful_calls(pool, tmp_path):
+    target = tmp_path / "keep.txt"
+    target.write_text("keep")
+    programs = [
+        f"import os\nos.remove({str(target)!r})",
+        f"import shutil\nshutil.rmtree({str(tmp_path)!r})",
+        "import subprocess\nsubprocess.run(['true'])",
+        "import os, signal\nos.kill(os.getppid(), signal.SIGKILL)",
+    ]
+    assert pool.run(programs) == [False, False, False, False]
+    assert target.read_text() == "keep"
+
+
+def test_pool_recovers_when_a_candidate_kills_its_worker(pool):
+    # ガードを回避してワーカーを停止させても、その候補だけが失敗になり残りは採点される
+    killer = "import ctypes, os\nctypes.CDLL(None).kill(os.getppid(), 9)"
+    programs = ["x = 1", killer, "x = 2", "assert False", "x = 3"]
+    assert pool.run(programs) == [True, False, True, False, True]
+    assert pool.run(["x = 1"]) == [True]
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models import HFModel
+from templates import load_template
+
+TINY_MODEL = "hf-internal-testing/tiny-random-LlamaForCausalLM"
+
+# 問題文は空白で始め、プレフィックス ("...Q:") との境界でトークン分割が変わらないようにする
+QUESTIONS = [" what is 1+1?", " name a color.", " how many legs does a spider have in total?"]
+
+
+# =====================
+# Helpers
+# =====================
+
+def load_tiny_model(model_args):
+    try:
+        return HFModel(TINY_MODEL, model_args=model_args, quantize=False)
+    except OSError as e:
+        pytest.skip(f"{TINY_MODEL} is not available: {e}")
+
+
+def write_template(tmp_path, template_data):
+    template_path = tmp_path / "template.json"
+    template_path.write_text(json.dumps(template_data), encoding="utf-8")
+    return load_template(str(template_path))
+
+
+# =====================
+# Prefix Cache
+# =====================
+
+def test_prefix_cache_matches_uncached_greedy_outputs(tmp_path):
+    template = write_template(tmp_path, {"template": "Answer briefly.\nQ:{question}\nA:", "stop_sequences": []})
+    prompts = [template.process({"question": question}) for question in QUESTIONS]
+    model_args = {"do_sample": False, "max_new_tokens": 8}
+
+    cached = load_tiny_model({**model_args, "prefix_cache": True})
+    cached.bind_template(template)
+    assert cached.split_prefix_ids(prompts) is not None, "the prefix cache path is not used for these prompts"
+
+    uncached = load_tiny_model(model_args)
+    uncached.bind_template(template)
+    assert uncached.split_prefix_ids(prompts) is None
+
+    assert cached.generate_batch(prompts) == uncached.generate_batch(prompts)
+    # 2回目以降はキャッシュ済みのプレフィックスを使う
+    assert cached.generate_batch(prompts[:1]) == uncached.generate_batch(prompts[:1])
+
+
+def test_pipeline_backend_never_uses_prefix_cache():
+    model = load_tiny_model({"do_sample": False, "max_new_tokens": 4, "backend": "pipeline", "prefix_cache": True})
+    assert model.prefix_cache is False
+
+
+# =====================
+# Stop Sequences
+# =====================
+
+def test_batched_generation_stops_each_row_at_its_stop_sequence(tmp_path):
+    template_data = {"template": "Answer briefly.\nQ:{question}\nA:", "stop_sequences": []}
+    template = write_template(tmp_path, template_data)
+    prompts = [template.process({"question": question}) for question in QUESTIONS]
+    model = load_tiny_model({"do_sample": False, "max_new_tokens": 16})
+    model.bind_template(template)
+    unstopped = [texts[0] for texts in model.generate_batch(prompts)]
+
+    # 1つ目のプロンプトの出力の前半から停止文字列を選ぶ (ランダムな重みのモデルでも必ず出現する)
+    text = unstopped[0]
+    stop = text[len(text) // 4:len(text) // 4 + 3]
+    if not stop.strip():
+        pytest.skip("the tiny model produced no usable text for a stop sequence")
+    template = write_template(tmp_path, {**template_data, "stop_sequences": [stop]})
+    model.bind_template(template)
+    stopped = [texts[0] for texts in model.generate_batch(prompts)]
+
+    # 停止した行は停止文字列を含んだ状態で打ち切られ、他の行は停止文字列が出るまで同じ出力になる
+    assert stop in stopped[0]
+    assert len(stopped[0]) < len(unstopped[0])
+    for stopped_text, unstopped_text in zip(stopped, unstopped):
+        assert unstopped_text.startswith(stopped_text)
+        if stop not in unstopped_text:
+            assert stopped_text == unstopped_text
+    # 行ごとに停止するため、バッチの組み合わせで出力は変わらない
+    assert [model.generate(prompt)[0] for prompt in prompts] == stopped
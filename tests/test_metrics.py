@@ -0,0 +1,86 @@
+import math
+
+import numpy as np
+import pytest
+
+from metrics import BLEUStats, bleu_from_sums, estimate_pass_at_k, mean_pass_at_k, tokenize_13a
+
+
+# =====================
+# pass@k
+# =====================
+
+def pass_at_k_formula(n, c, k):
+    """pass@k = 1 - C(n - c, k) / C(n, k), or NaN when there are fewer than k samples."""
+    if n < k:
+        return math.nan
+    return 1.0 - math.comb(n - c, k) / math.comb(n, k)
+
+
+@pytest.mark.parametrize("k", [1, 2, 5, 10])
+def test_pass_at_k_matches_combinatorial_formula(k):
+    cases = [(n, c) for n in [1, 3, 5, 10, 20, 200] for c in sorted({0, 1, n // 2, n - 1, n}) if c >= 0]
+    num_samples = [n for n, _ in cases]
+    num_correct = [c for _, c in cases]
+
+    expected = np.array([pass_at_k_formula(n, c, k) for n, c in cases])
+    actual = estimate_pass_at_k(num_samples, num_correct, k)
+    np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_pass_at_k_edge_cases():
+    # c = 0 は 0、c = n は 1、k > n は NaN (平均から除外される)
+    np.testing.assert_array_equal(estimate_pass_at_k([5, 5, 3], [0, 5, 1], 4), [0.0, 1.0, np.nan])
+    assert estimate_pass_at_k([], [], 1).size == 0
+    assert mean_pass_at_k([5, 3], [5, 1], [1, 4]) == {"pass@1": pytest.approx((1.0 + 1 / 3) / 2), "pass@4": 1.0}
+
+
+# =====================
+# BLEU
+# =====================
+
+@pytest.mark.parametrize("text, tokens", [
+    ("Hello, world! It costs $3.50 (approx.)", ["Hello", ",", "world", "!", "It", "costs", "$", "3.50", "(", "approx", ".", ")"]),
+    ('"Quoted" &amp; escaped &lt;tag&gt;', ['"', "Quoted", '"', "&", "escaped", "<", "tag", ">"]),
+    ("state-of-the-art 1990-2000, e.g. x.y", ["state-of-the-art", "1990", "-", "2000", ",", "e", ".", "g", ".", "x", ".", "y"]),
+    ("multi-\nline\ntext.", ["multiline", "text", "."]),
+])
+def test_tokenize_13a_matches_sacrebleu(text, tokens):
+    # 期待値は sacrebleu の Tokenizer13a の出力
+    assert tokenize_13a(text) == tokens
+
+
+HYPOTHESES = ["The cat sat on the mat.", "There is a dog in the garden, barking loudly.", "It is raining today in Tokyo."]
+REFERENCES = ["The cat is sitting on the mat.", "A dog is barking loudly in the garden.", "It is raining in Tokyo today."]
+
+
+def corpus_stats(hypotheses, references):
+    stats = BLEUStats()
+    for hypothesis, reference in zip(hypotheses, references):
+        stats.add(tokenize_13a(hypothesis), [tokenize_13a(reference)])
+    return stats
+
+
+def test_bleu_matches_sacrebleu():
+    # 期待値は sacrebleu.corpus_bleu(..., smooth_method="none", tokenize="13a") の値
+    # (参照訳が1つの場合、平滑化なしの nmt BLEU は sacrebleu と一致する)
+    stats = corpus_stats(HYPOTHESES, REFERENCES)
+    assert stats.to_dict() == {
+        "matches": [21, 10, 4, 1], "possible": [25, 22, 19, 16], "translation_length": 25, "reference_length": 24,
+    }
+    assert stats.score(smooth=False) * 100 == pytest.approx(26.623230561556213)
+
+    # 2行目は参照訳より短い訳文 (brevity penalty あり)、3行目は一致する n-gram がない訳文
+    sums = [
+        stats.to_vector(),
+        corpus_stats(HYPOTHESES[:1], REFERENCES[:1]).to_vector(),
+        corpus_stats(HYPOTHESES[1:2], REFERENCES[1:2]).to_vector(),
+    ]
+    np.testing.assert_allclose(bleu_from_sums(sums, smooth=False) * 100, [26.623230561556213, 42.38365628278778, 0.0])
+
+
+def test_bleu_from_sums_matches_bleu_stats():
+    sums = [corpus_stats(HYPOTHESES[:i], REFERENCES[:i]).to_vector() for i in range(1, len(HYPOTHESES) + 1)]
+    for smooth in [True, False]:
+        expected = [corpus_stats(HYPOTHESES[:i], REFERENCES[:i]).score(smooth=smooth) for i in range(1, len(HYPOTHESES) + 1)]
+        np.testing.assert_allclose(bleu_from_sums(sums, smooth=smooth), expected)
@@ -0,0 +1,185 @@
+import json
+import os
+import shutil
+import threading
+
+import pytest
+
+from results_handling import (
+    compress_block, format_rows, group_and_aggregate_results, index_path, load_existing_results,
+    load_processed_ids, load_result_writer, merge_shard_results, read_index, result_codec, shard_result_path,
+)
+
+RECORD = {"model": "fake-model", "dataset": "fake-dataset", "template": "fake-template"}
+
+FILE_SUFFIXES = [".jsonl", ".jsonl.gz", ".norm.jsonl", ".norm.jsonl.gz", ".norm.jsonl.zst"]
+ALL_SUFFIXES = FILE_SUFFIXES + [".sqlite"]
+
+
+# =====================
+# Helpers
+# =====================
+
+def make_items(start, stop, num_samples=2):
+    return [
+        {
+            "id": f"item-{i}",
+            "model_input": f"prompt {i}\n日本語の入力",
+            "model_output": [f"output {i}-{j}" for j in range(num_samples)],
+            "formatted_output": [f"formatted {i}-{j}" for j in range(num_samples)],
+            "format_checked": [True] * num_samples,
+            "output_format": "default",
+            "reference": f"reference {i}",
+            "item_score": float(i % 2),
+            "num_samples": num_samples,
+            "num_correct": (i % 2) * num_samples,
+        }
+        for i in range(start, stop)
+    ]
+
+
+def expected_rows(items):
+    return [json.loads(line) for data in items for line in format_rows(data, RECORD)]
+
+
+def result_path_for(tmp_path, suffix):
+    if suffix.endswith(".zst"):
+        pytest.importorskip("zstandard")
+    return str(tmp_path / f"result{suffix}")
+
+
+def write_items(result_path, items, one_commit_per_item=False):
+    with load_result_writer(result_path, RECORD, commit_interval=0) as writer:
+        if one_commit_per_item:
+            for data in items:
+                writer.write([data])
+        else:
+            writer.write(items)
+
+
+def ids_of(items):
+    return {data["id"] for data in items}
+
+
+# =====================
+# Round Trip and Resume
+# =====================
+
+@pytest.mark.parametrize("suffix", ALL_SUFFIXES)
+def test_round_trip(tmp_path, suffix):
+    result_path = result_path_for(tmp_path, suffix)
+    items = make_items(0, 5)
+    write_items(result_path, items)
+
+    assert load_existing_results(result_path) == expected_rows(items)
+    grouped = group_and_aggregate_results(load_existing_results(result_path))
+    assert [data["model_output"] for data in grouped] == [data["model_output"] for data in items]
+    assert load_processed_ids(result_path) == ids_of(items)
+    if suffix in FILE_SUFFIXES:
+        ids, end = read_index(result_path)
+        assert ids == [data["id"] for data in items]
+        assert end == os.path.getsize(result_path)
+
+
+@pytest.mark.parametrize("suffix", ALL_SUFFIXES)
+def test_resume_appends_to_existing_results(tmp_path, suffix):
+    result_path = result_path_for(tmp_path, suffix)
+    write_items(result_path, make_items(0, 3), one_commit_per_item=True)
+    assert load_processed_ids(result_path) == ids_of(make_items(0, 3))
+
+    write_items(result_path, make_items(3, 6))
+    assert load_existing_results(result_path) == expected_rows(make_items(0, 6))
+    assert load_processed_ids(result_path) == ids_of(make_items(0, 6))
+
+
+@pytest.mark.parametrize("suffix", FILE_SUFFIXES)
+def test_resume_after_truncated_tail(tmp_path, suffix):
+    result_path = result_path_for(tmp_path, suffix)
+    write_items(result_path, make_items(0, 3), one_commit_per_item=True)
+    committed_size = os.path.getsize(result_path)
+
+    # 異常終了で途中まで書かれたコミットを末尾に残す: 非圧縮では1行目は完全で2行目の途中まで
+    # (アイテムの一部だけが書かれた状態)、圧縮では途中で切れた圧縮ブロック
+    partial = "".join(format_rows(make_items(3, 4)[0], RECORD)).encode("utf-8")
+    codec = result_codec(result_path)
+    tail = partial[:partial.index(b"\n") + 10] if codec is None else compress_block(codec, partial)[:-8]
+    with open(result_path, "ab") as f:
+        f.write(tail)
+
+    # 再開時は処理済みの id を読む時点で末尾が修復される
+    assert load_processed_ids(result_path) == ids_of(make_items(0, 3))
+    assert os.path.getsize(result_path) == committed_size
+    assert load_existing_results(result_path) == expected_rows(make_items(0, 3))
+
+    write_items(result_path, make_items(3, 5))
+    assert load_existing_results(result_path) == expected_rows(make_items(0, 5))
+    assert load_processed_ids(result_path) == ids_of(make_items(0, 5))
+
+
+@pytest.mark.parametrize("suffix", FILE_SUFFIXES)
+def test_stale_index_is_rebuilt(tmp_path, suffix):
+    result_path = result_path_for(tmp_path, suffix)
+    write_items(result_path, make_items(0, 2))
+    old_index = str(tmp_path / "old.idx")
+    shutil.copy(index_path(result_path), old_index)
+    write_items(result_path, make_items(2, 4))
+
+    # 索引が結果ファイルの一部しか覆っていない場合
+    shutil.copy(old_index, index_path(result_path))
+    assert load_processed_ids(result_path) == ids_of(make_items(0, 4))
+
+    # 索引が別の (長い) ファイルのものである場合
+    longer_index = str(tmp_path / "longer.idx")
+    shutil.copy(index_path(result_path), longer_index)
+    os.remove(result_path)
+    write_items(result_path, make_items(0, 1))
+    shutil.copy(longer_index, index_path(result_path))
+    assert load_processed_ids(result_path) == ids_of(make_items(0, 1))
+
+    # 書き込み側も古い索引を作り直してから追記する
+    shutil.copy(old_index, index_path(result_path))
+    write_items(result_path, make_items(1, 3))
+    assert load_existing_results(result_path) == expected_rows(make_items(0, 3))
+    assert read_index(result_path) == ([data["id"] for data in make_items(0, 3)], os.path.getsize(result_path))
+
+
+# =====================
+# Worker Shards
+# =====================
+
+@pytest.mark.parametrize("suffix", FILE_SUFFIXES)
+def test_merge_shard_results(tmp_path, suffix):
+    result_path = result_path_for(tmp_path, suffix)
+    write_items(result_path, make_items(0, 2))
+    shards = [make_items(2, 4), make_items(4, 7), make_items(7, 8)]
+    for i, items in enumerate(shards):
+        write_items(shard_result_path(result_path, i), items)
+    # 同じ名前で始まるが、このマージ先のシャードではないファイル
+    unrelated_path = str(tmp_path / f"result.shard0.old{suffix}")
+    write_items(unrelated_path, make_items(100, 101))
+
+    merged = merge_shard_results(result_path)
+    assert merged == expected_rows(make_items(2, 8))
+    assert load_existing_results(result_path) == expected_rows(make_items(0, 8))
+    assert load_processed_ids(result_path) == ids_of(make_items(0, 8))
+    for i in range(len(shards)):
+        assert not os.path.exists(shard_result_path(result_path, i))
+        assert not os.path.exists(index_path(shard_result_path(result_path, i)))
+    assert load_existing_results(unrelated_path) == expected_rows(make_items(100, 101))
+    assert merge_shard_results(result_path) == []
+
+
+def test_database_accepts_concurrent_writers(tmp_path):
+    result_path = result_path_for(tmp_path, ".sqlite")
+    shards = [make_items(0, 20), make_items(20, 40), make_items(40, 60)]
+    threads = [threading.Thread(target=write_items, args=(result_path, items, True)) for items in shards]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert load_processed_ids(result_path) == ids_of(make_items(0, 60))
+    rows = sorted(load_existing_results(result_path), key=lambda row: (int(row["id"].split("-")[1]), row["model_output"]))
+    assert rows == expected_rows(make_items(0, 60))
+    # ワーカーはデータベースに直接書き込むため、マージするシャードはない
+    assert merge_shard_results(result_path) == []
@@ -0,0 +1,41 @@
+import threading
+
+import pytest
+
+from stages import StagePipeline
+
+
+def test_pipeline_keeps_order():
+    written = []
+    stages = [("double", lambda x: x * 2), ("increment", lambda x: x + 1), ("write", written.append)]
+    StagePipeline(stages).run(range(20))
+    assert written == [x * 2 + 1 for x in range(20)]
+
+
+def test_failure_stops_upstream_and_drains_downstream():
+    written = []
+    generated = []
+    released = threading.Event()
+
+    def generate(x):
+        generated.append(x)
+        return x
+
+    def score(x):
+        if x == 3:
+            released.set()
+            raise ValueError("score failed")
+        return x
+
+    def write(x):
+        # 採点が失敗するまで書き込みを止め、失敗時点で書き込みのキューに項目が残るようにする
+        released.wait(timeout=5)
+        written.append(x)
+
+    stages = [("generate", generate), ("score", score), ("write", write)]
+    with pytest.raises(ValueError, match="score failed"):
+        StagePipeline(stages, queue_size=2).run(range(100))
+
+    # 失敗より前に採点された項目はすべて書き込まれ、失敗後の項目は採点も書き込みもされない
+    assert written == [0, 1, 2]
+    assert len(generated) < 100